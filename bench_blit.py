@@ -0,0 +1,92 @@
+#!/usr/bin/env python2
+# -*- coding: utf8 -*-
+
+# fxp2 - Multiplayer platform RPG
+# Copyright (C) 2009 - 2013 MARTIN Jérôme <poupoule.studios@sfr.fr>
+# This file is part of the fxp2 program.
+#
+# fxp2 is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# fxp2 is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import sys
+import time
+
+import fxplib as Fxp
+from model import Model
+
+
+class Main:
+    """ Blit the same image converted to the display format or not,
+        to measure what format conversions cost on every blit """
+    def __init__(self, count=2000):
+        self.count = count
+
+        # an 8 bits display like the game's, without a window
+        if not "SDL_VIDEODRIVER" in os.environ:
+            os.environ["SDL_VIDEODRIVER"] = "dummy"
+        Fxp.pygame.init()
+        self.screen = Fxp.pygame.display.set_mode((512, 384), 0, 8)
+
+        Fxp.PALETTE = Model().get_palette(
+            "packages/Manafia/palettes/rilouw.pal")
+        Fxp.set_display(self.screen)
+        self.screen.set_palette(Fxp.PALETTE.get_all_rgb())
+
+        filename = "packages/Manafia/maps/Golfia/portal.png"
+        raw = Fxp.pygame.image.load(filename)
+        image = Fxp.ASSETS.load_image(filename)
+
+        # the same colors in another palette order
+        other = Fxp.Surface(image.get_size())
+        palette = list(reversed(image.get_palette()))
+        other.set_palette(palette)
+        other.blit(image, (0, 0))
+        other.set_colorkey(Fxp.PALETTE.get_colorkey())
+
+        # the same pixels in 32 bits
+        truecolor = Fxp.pygame.Surface(image.get_size(), 0, 32)
+        truecolor.blit(image, (0, 0))
+        truecolor.set_colorkey(Fxp.PALETTE.get_colorkey())
+
+        raw.set_colorkey(Fxp.PALETTE.get_colorkey())
+
+        self.images = [("display format", image),
+                       ("other palette", other),
+                       ("decoded png", raw),
+                       ("32 bits", truecolor)]
+
+    def blit(self, image):
+        start = time.time()
+        for i in range(self.count):
+            self.screen.blit(image, (i % 64, i % 48))
+
+        return time.time() - start
+
+    def start(self):
+        reference = None
+        for name, image in self.images:
+            duration = self.blit(image)
+            if reference is None:
+                reference = duration
+
+            print("{:<16}{:>4} bits  {:>8.0f} blits/s  {:.2f}x time".format(
+                  name, image.get_bitsize(), self.count / duration,
+                  duration / reference))
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1:
+        main = Main(int(sys.argv[1]))
+    else:
+        main = Main()
+    main.start()
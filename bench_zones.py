@@ -0,0 +1,89 @@
+#!/usr/bin/env python2
+# -*- coding: utf8 -*-
+
+# fxp2 - Multiplayer platform RPG
+# Copyright (C) 2009 - 2013 MARTIN Jérôme <poupoule.studios@sfr.fr>
+# This file is part of the fxp2 program.
+#
+# fxp2 is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# fxp2 is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import os
+import sys
+import time
+
+import fxplib as Fxp
+from model import Model
+
+
+class Main:
+    """ Walk an object through the portal of the zones test package,
+        to measure the frames spent while the zones are streamed """
+    def __init__(self, speed=4):
+        self.speed = speed
+
+        # an 8 bits display like the game's, without a window
+        if not "SDL_VIDEODRIVER" in os.environ:
+            os.environ["SDL_VIDEODRIVER"] = "dummy"
+        Fxp.pygame.init()
+        self.screen = Fxp.pygame.display.set_mode((512, 384), 0, 8)
+
+        Fxp.PALETTE = Model().get_palette(
+            "packages/Manafia/palettes/rilouw.pal")
+        Fxp.set_display(self.screen)
+        self.screen.set_palette(Fxp.PALETTE.get_all_rgb())
+
+        builder = Fxp.Builder("packages/_Zones")
+        self.root = builder.root
+        self.root.load_from_solid_color(Fxp.PALETTE.get_rgb("White", "light"),
+                                        (512, 384))
+
+        self.zones = Fxp.Zones(self.root)
+
+        # the object walking from west to east
+        self.walker = Fxp.MovingObject("walker")
+        self.walker.set_rect((0, 192, 16, 16))
+        self.walker.z = 1
+        self.root.add_child(self.walker)
+
+    def frame(self):
+        start = time.time()
+
+        self.zones.update(self.walker)
+        self.zones.run()
+        self.root.render(self.screen)
+
+        return time.time() - start
+
+    def start(self):
+        durations = []
+        x, y = self.walker.get_pos()
+        while x < 1024 - 16:
+            self.walker.set_pos((x + self.speed, y))
+            durations.append(self.frame())
+            x, y = self.walker.get_pos()
+
+        zones = self.zones
+        print("{} frames  {:.2f} ms average  {:.2f} ms max".format(
+              len(durations), sum(durations) * 1000 / len(durations),
+              max(durations) * 1000))
+        print("{} hits  {} misses  {} preloads  {} unloads".format(
+              zones.hits, zones.misses, zones.preloads, zones.unloads))
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1:
+        main = Main(int(sys.argv[1]))
+    else:
+        main = Main()
+    main.start()
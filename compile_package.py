@@ -0,0 +1,57 @@
+#!/usr/bin/env python2
+# -*- coding: utf8 -*-
+
+# fxp2 - Multiplayer platform RPG
+# Copyright (C) 2009 - 2013 MARTIN Jérôme <poupoule.studios@sfr.fr>
+# This file is part of the fxp2 program.
+#
+# fxp2 is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# fxp2 is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import sys
+
+import fxplib as Fxp
+from model import Model
+
+
+class Main:
+    """ Compile packages in bundles, loaded instead of the package files
+        as long as they are not modified """
+    def __init__(self, packages):
+        self.model = Model()
+        self.packages = packages
+
+        # palettes need a display, even without a window
+        if not "SDL_VIDEODRIVER" in os.environ:
+            os.environ["SDL_VIDEODRIVER"] = "dummy"
+        Fxp.pygame.init()
+
+        # the images are compiled in the format of the game's display
+        Fxp.PALETTE = self.model.get_palette(
+            "packages/Manafia/palettes/rilouw.pal")
+
+    def start(self):
+        for package in self.packages:
+            self.model.compile_package(package)
+            print("packages/{}.fxpb".format(package))
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1:
+        packages = sys.argv[1:]
+    else:
+        packages = [name for name in sorted(os.listdir("packages"))
+                    if os.path.isdir("packages/" + name)]
+
+    main = Main(packages)
+    main.start()
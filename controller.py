@@ -29,37 +29,62 @@ class Controller:
         self.quit = False
         self.root = None
 
-        # scenes
-        self.title = None
-        self.game = None
+        # scenes, the next one is built while the current one runs
+        self.scenes = Fxp.Scenes()
+
+        # zones of the current scene, streamed around the current one,
+        # and the zones of each scene, kept to go on when it is shown again
+        self.zones = None
+        self.scene_zones = {}  # name -> (root, zones)
+
+    def set_root(self, name, root):
+        # change current root and send it to the view
+        self.root = root
+        self.view.root = root
+
+        # forget the zones of the scenes dropped from the cache
+        for other in self.scene_zones.keys():
+            if not other in self.scenes.scenes:
+                del self.scene_zones[other]
+
+        # the scene may have been built again since it was shown
+        scene_root, self.zones = self.scene_zones.get(name, (None, None))
+        if scene_root is not root:
+            self.zones = Fxp.Zones(root)
+            self.scene_zones[name] = (root, self.zones)
 
     def load_title(self):
-        if self.title:
-            # change current root
-            self.root = self.title
-            self.view.root = self.title
-        else:
-            # load package
-            root = self.model.load_package("_Title",
-                                           self.view.get_size(),
-                                           self.view.scale)
-            self.root = root
-
-            # cache object tree
-            self.title = root
-
-            # send object tree to the view
-            self.view.root = root
-
-            # connect signals
-            inputdev = self.root.get_child("inputdev")
-            inputdev.connect_signal("quit", self.on_title_input_quit)
-            inputdev.connect_signal("keydown", self.on_title_input_keydown)
+        self.set_root("title", self.scenes.load("title", self.build_title))
+
+        # get the game ready while the title is shown
+        self.scenes.preload("game", self.build_game)
+
+    def build_title(self):
+        # load package
+        root = self.model.load_package("_Title",
+                                       self.view.get_size(),
+                                       self.view.scale)
+
+        # connect signals
+        inputdev = root.get_child("inputdev")
+        inputdev.connect_signal("quit", self.on_title_input_quit)
+        inputdev.connect_signal("keydown", self.on_title_input_keydown)
+
+        yield root
 
     def load_game(self):
+        root = self.scenes.load("game", self.build_game)
+
+        # the game is shown again as it was left, without its menu
+        root.get_child("gui/window").close()
+
+        self.set_root("game", root)
+
+    def build_game(self):
         # load view
-        self.view.load_game()
-        self.root = self.view.root
+        for root in self.view.build_game():
+            if root is None:
+                yield None
 
         # options
         speed = 0.30
@@ -69,11 +94,11 @@ class Controller:
         #Fxp.pygame.key.set_repeat(30, 30)
 
         # get objects and connect signals
-        btn_disconnect = self.root.get_child("gui/window/button_disconnect")
-        btn_options    = self.root.get_child("gui/window/button_options")
-        btn_quit       = self.root.get_child("gui/window/button_quit")
-        world        = self.root.get_child("world")
-        inputdev     = self.root.get_child("inputdev")
+        btn_disconnect = root.get_child("gui/window/button_disconnect")
+        btn_options    = root.get_child("gui/window/button_options")
+        btn_quit       = root.get_child("gui/window/button_quit")
+        world        = root.get_child("world")
+        inputdev     = root.get_child("inputdev")
 
         btn_disconnect.connect_signal("click", self.on_button_disconnect_click)
         btn_options.connect_signal("click", self.on_button_options_click)
@@ -84,6 +109,8 @@ class Controller:
         inputdev.connect_signal("quit", self.on_game_input_quit)
         inputdev.connect_signal("keydown", self.on_game_input_keydown)
 
+        yield root
+
     # execute a new program loop
     def loop(self):
         while not self.quit and self.root:
@@ -93,23 +120,27 @@ class Controller:
 
             mouse_pos = inputdev.mouse_pos
 
-            if(self.view.scale == "simple"
-            or self.view.scale == "scale2x"):
-                mouse_pos = (mouse_pos[0] / 2, mouse_pos[1] / 2)
+            if self.view.is_scale():
+                mouse_pos = (mouse_pos[0] / self.view.factor,
+                             mouse_pos[1] / self.view.factor)
 
             # test keys
             character = self.root.get_child("world/camera/character")
             gauge = self.root.get_child("gui/gauge")
             if character:
-                character.frame = "idle"
+                frame = "idle"
                 if inputdev.check_key(Fxp.pygame.K_q):
                     character.apply_vector(self.VECTOR_LEFT)
                     character.flip(state=True)
-                    character.frame = "run"
+                    frame = "run"
                 if inputdev.check_key(Fxp.pygame.K_d):
                     character.apply_vector(self.VECTOR_RIGHT)
                     character.flip(state=False)
-                    character.frame = "run"
+                    frame = "run"
+                character.play(frame)
+
+                # walk through the portals
+                self.zones.update(character)
 
             # update cursor position
             cursor = self.root.get_child("gui/cursor")
@@ -130,15 +161,16 @@ class Controller:
             # move objects
             self.root.move_all()
 
-            # check objects refresh
-            self.root.check_force()
-
             # execute signals
             self.root.execute_signals()
 
             # refresh screen
             self.view.refresh()
 
+            # build the next scenes and zones in the background
+            self.scenes.run()
+            self.zones.run()
+
     def quit_loop(self):
         self.quit = True
 
@@ -163,11 +195,11 @@ class Controller:
         if key == Fxp.pygame.K_f:
             character = self.root.get_child("world/camera/character")
             camera = self.root.get_child("world/camera")
-            camera.target = character
+            camera.set_target(character)
         if key == Fxp.pygame.K_g:
             tree = self.root.get_child("world/camera/ennemy")
             camera = self.root.get_child("world/camera")
-            camera.target = tree
+            camera.set_target(tree)
         if key == Fxp.pygame.K_SPACE:
             self.root.get_child("world/camera/character")\
                      .apply_vector(self.VECTOR_UP)
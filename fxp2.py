@@ -18,6 +18,8 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import sys
+
 from view import View
 from model import Model
 from controller import Controller
@@ -27,12 +29,13 @@ from controller import Controller
 
 
 class Main:
-    def __init__(self):
+    def __init__(self, render_mode="full"):
         # Model-View-Controller creation
         self.model = Model()
         self.view = View(self.model, (512, 384),
                          scale_mode="simple",
-                         fullscreen=False)
+                         fullscreen=False,
+                         render_mode=render_mode)
         self.controller = Controller(self.model, self.view)
 
         # Start from the main menu
@@ -42,5 +45,9 @@ class Main:
         self.controller.loop()
 
 if __name__ == "__main__":
-    main = Main()
+    # the render mode is "full", or "dirty" or "flat" to try them
+    if len(sys.argv) > 1:
+        main = Main(sys.argv[1])
+    else:
+        main = Main()
     main.start()
@@ -23,16 +23,58 @@ from __future__ import print_function
 import pygame
 pygame.init()
 
+import collections
+import cStringIO
+import hashlib
+import heapq
+import marshal
 import math
+import mmap
+import multiprocessing
+import multiprocessing.pool
 import operator
+import os
 import random
+import struct
+import sys
+import threading
+import weakref
+import zipfile
 import xml.etree.ElementTree as ET
 
+# numpy is optional, it speeds up map baking
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 # global palette and font are
 # mandatory to use Fxplib FIXME
 PALETTE = None
 FONT = None
 
+# live surfaces, recolored when the palette changes
+SURFACES = weakref.WeakSet()
+
+# factor of each scaling method of the surface buffers
+# "scale" methods smooth the pixels with scale2x, once per doubling
+SCALES = {"simple": 2, "simple3x": 3, "simple4x": 4,
+          "scale2x": 2, "scale4x": 4}
+
+# surface the assets are blitted on, and the palette its pixels use,
+# the surfaces are created in the same format so that blits need no mapping
+DISPLAY = None
+LAYOUT = None
+
+# compiled and archived packages by directory, None if there is none
+BUNDLES = {}
+ARCHIVES = {}
+
+# palettes parsed by load_palette, by digest of their file,
+# and the digests by file with the date and size they were read at
+PALETTES = {}
+PALETTE_FILES = {}
+
 
 #------------------------------------------------------------------------------
 # CORE
@@ -63,6 +105,14 @@ class Object:
         if not obj.name in self.objects:
             self.objects[obj.name] = obj
 
+    def remove_child(self, name):
+        """ Remove a child, which stops using its shared images """
+        obj = self.objects.pop(name, None)
+        if obj is not None:
+            obj.release_all()
+
+        return obj
+
     def get_sorted_children(self):
         # return children sorted by priority
         return sorted(self.objects.values(), key=operator.attrgetter("z"))
@@ -71,13 +121,32 @@ class Object:
         name, sep, rest = path.partition("/")
 
         try:
-            if rest != "":
-                return self.objects[name].get_child(rest)
-            else:
-                return self.objects[name]
+            obj = self.objects[name]
         except KeyError:
             return None
 
+        # lazy objects are built when they are first accessed
+        obj.activate()
+
+        if rest != "":
+            return obj.get_child(rest)
+        else:
+            return obj
+
+    def activate(self):
+        """ Build the content of a lazy object, if it is not built yet """
+        pass
+
+    def release(self):
+        """ Stop using the shared resources of the object only """
+        pass
+
+    # NOTE : recursive
+    def release_all(self):
+        self.release()
+        for obj in self.objects.values():
+            obj.release_all()
+
     def add_signal(self, name):
         if not name in self.signals:
             self.signals[name] = Signal(name)
@@ -103,20 +172,38 @@ class Object:
             signal.execute(self)
 
     # NOTE : recursive
-    def tick(self, time):
+    def render(self, surface):
         for obj in self.get_sorted_children():
-            obj.tick(time)
+            obj.render(surface)
 
     # NOTE : recursive
-    def render(self, surface):
+    def update_dirty(self, surface):
+        rects = []
         for obj in self.get_sorted_children():
-            obj.render(surface)
+            rects += obj.update_dirty(surface)
+
+        return rects
+
+    # NOTE : recursive
+    def blit_on(self, surface):
+        for obj in self.get_sorted_children():
+            obj.blit_on(surface)
+
+    # NOTE : recursive
+    def compose(self, blits, x, y, clip):
+        for obj in self.get_sorted_children():
+            obj.compose(blits, x, y, clip)
 
     # NOTE : recursive
     def check_force(self):
         for obj in self.objects.values():
             obj.check_force()
 
+    # NOTE : recursive
+    def set_redraw(self):
+        for obj in self.objects.values():
+            obj.set_redraw()
+
     # NOTE : recursive
     def update_focus(self, mouse_pos):
         for obj in self.objects.values():
@@ -132,6 +219,18 @@ class Object:
         for obj in self.objects.values():
             obj.move_all(vectors, move)
 
+    # NOTE : recursive
+    def start(self):
+        """ Run the "start" scripts of the object and its children now """
+        for obj in self.objects.values():
+            obj.start()
+
+        for name, script in self.scripts.items():
+            exec_type, file, text = script
+            if exec_type == "start":
+                self.eval(file, text)
+                self.scripts.pop(name)
+
     # NOTE : recursive
     def execute(self):
         for obj in self.objects.values():
@@ -269,6 +368,7 @@ class Image (Object):
         self.z = 0.0
 
         self.fixed_to = None
+        self.followers = []  # objects fixed to this one
 
         self.x_offset = 0
         self.y_offset = 0
@@ -284,17 +384,40 @@ class Image (Object):
         self.state = "IDLE"  # IDLE, MOUSEOVER, CLICKED
         self.surface = None
         self.image = None
+        self.asset = None  # (filename, transforms) of a shared image
         self.frames = {}
         self.frame = ""
         self.last_tick = 0
 
+        # position in the shared animation clip being played
+        self.frame_playing = None
+        self.frame_index = 0
+        self.frame_timer = None  # timer of the next frame in the scheduler
+
         self.focused = False
         self.display = True
         self.force = False
-        self.scale = ""  # Nothing, "simple" or "scale2x"
+        self.force_children = False
+        self.redraw = False  # the image was modified in place
+        self.scale = ""  # Nothing or one of SCALES
+        self.scaled = None  # scaled copy of the surface buffer
+
+        # what was rendered last time
+        self.drawn = (None, None)
+        self.last_bounds = None
+        self.dirty_ratio = 0.5
+
+        # keep the children on the surface buffer when composing
+        self.layer = False
 
         self.filename = filename
 
+        # (builder, record) of a lazy object, whose content is built
+        # only when it is used, and the steps of the build in progress
+        self.loader = None
+        self.loaded = True
+        self.activation = None
+
         # open image if filename is given
         if filename:
             self.load_from_file(filename)
@@ -306,6 +429,59 @@ class Image (Object):
     def load(self):
         pass
 
+    def activate(self):
+        """ Build the content of a lazy object, if it is not built yet.
+            Its "start" scripts are run at once, before it is shown.
+        """
+        for step in self.activate_steps(wait=True):
+            pass
+
+    def activate_steps(self, wait=False):
+        """ Same as activate, step by step: None is yielded after each step.
+            A build left unfinished is resumed by the next activation.
+        """
+        if self.loaded:
+            return
+
+        if self.activation is None:
+            builder, record = self.loader
+            self.activation = builder.fill_steps(self, record, wait)
+
+        try:
+            for step in self.activation:
+                yield None
+        except Exception:
+            self.activation = None
+            raise
+
+        # another activation may have finished the build
+        if not self.loaded:
+            self.loaded = True
+            self.activation = None
+            self.start()
+            self.force = True
+
+    def unload(self):
+        """ Drop the children and the images of a lazy object,
+            they are built again the next time the object is used.
+        """
+        if self.loader and self.loaded:
+            builder, record = self.loader
+            builder.forget(self)
+
+            self.release()
+            self.objects = {}
+            self.scripts = {}
+            self.image = None
+            self.surface = None
+            self.scaled = None
+            self.drawn = (None, None)
+            self.force = True
+            self.loaded = False
+
+    def release(self):
+        self.release_asset()
+
     def load_from_solid_color(self, color, size):
         self.image = Surface(size)
         self.image.fill(color)
@@ -313,15 +489,46 @@ class Image (Object):
         self.set_size(size)
 
     def load_from_file(self, filename):
-        image = pygame.image.load(filename)
-        w, h = image.get_size()
+        self.load_asset(filename)
 
-        temp = Surface((w, h))
-        temp.blit(image, (0, 0))
+        self.set_size(self.image.get_size())
 
-        self.image = temp
+    def load_asset(self, filename, transforms=()):
+        """ Use the shared image of a file from the asset cache,
+            with the given transforms applied to it.
+        """
+        global ASSETS
+        image = ASSETS.load_image(filename, transforms)
 
-        self.set_size((w, h))
+        self.release_asset()
+        self.asset = (filename, transforms)
+        self.image = image
+        self.surface = None
+
+    def release_asset(self):
+        """ Stop using the shared image, so that it can be evicted """
+        global ASSETS
+        if self.asset:
+            ASSETS.release(self.asset)
+            self.asset = None
+
+    def transform(self, transform):
+        """ Replace the image by a transformed copy of it.
+            Shared images are never modified, the copy is shared as well.
+        """
+        if self.asset:
+            filename, transforms = self.asset
+            self.load_asset(filename, transforms + (transform,))
+        else:
+            self.image = transform_surface(self.image, transform)
+            self.surface = None
+
+    def recolor(self, old_rgb, new_rgb, swap=False):
+        """ Replace a color of the image by another one.
+            If "swap" is True, the other color is replaced as well.
+        """
+        if self.image:
+            self.transform(("recolor", tuple(old_rgb), tuple(new_rgb), swap))
 
     def load_from_stock(self, stock_id):
         pass
@@ -357,50 +564,8 @@ class Image (Object):
         if not horizontal and self.v_mode == "mirrored":
             return
 
-        # get the corresponding dimensions
-        iw, ih = self.image.get_size()
-        if horizontal:
-            w = iw * 2
-            h = ih
-        else:
-            w = iw
-            h = ih * 2
-
-        # create a new surface
-        temp = Surface((w, h))
-
-        # blit self image on the new surface
-        temp.blit(self.image, (0, 0))
-
-        # check optional rect argument
-        if rect:
-            rw = rect[0]
-            rh = rect[1]
-            t = Surface((rw, rh))
-        else:
-            rw = iw
-            rh = ih
-            t = self.image
-
-        # flip and blit image frame by frame
-        for y in range(0, ih, rh):
-            for x in range(0, iw, rw):
-                # extract frame
-                if t is not self.image:
-                    t.clear()
-                    t.blit(self.image, (0, 0), area=(x, y, rw, rh))
-
-                # blit flipped frame
-                if horizontal:
-                    img = pygame.transform.flip(t, True, False)
-                    temp.blit(img, (iw + x, y))
-                else:
-                    img = pygame.transform.flip(t, False, True)
-                    temp.blit(img, (x, ih + y))
-
         # apply the new surface
-        self.image = temp
-        self.surface = None
+        self.transform(("mirror", horizontal, tuple(rect) if rect else None))
 
         if horizontal:
             self.h_mode = "mirrored"
@@ -450,6 +615,8 @@ class Image (Object):
         self.w = w * g
         self.h = h * g
 
+        self.move_followers()
+
     def get_rect(self, grid=False):
         g = self.grid_size if grid else 1
 
@@ -465,10 +632,12 @@ class Image (Object):
 
         g = self.grid_size if grid else 1
 
-        self.x = x * g
-        self.y = y * g
+        if (self.x, self.y) != (x * g, y * g):
+            self.x = x * g
+            self.y = y * g
 
-        self.force = True
+            self.force = True
+            self.move_followers()
 
     def get_pos(self, grid=False):
         g = self.grid_size if grid else 1
@@ -480,10 +649,11 @@ class Image (Object):
 
         g = self.grid_size if grid else 1
 
-        self.w = w * g
-        self.h = h * g
+        if (self.w, self.h) != (w * g, h * g):
+            self.w = w * g
+            self.h = h * g
 
-        self.force = True
+            self.force = True
 
     def get_size(self, grid=False):
         g = self.grid_size if grid else 1
@@ -497,9 +667,39 @@ class Image (Object):
         w, h = self.get_size()
         return (w / 2, h / 2)
 
+    def get_bounds(self):
+        """ Return the rect covered by the object on its parent.
+
+            Children are rendered on the object's own surface,
+            so they never draw outside of this rect.
+        """
+        x = self.x + self.x_offset
+        y = self.y + self.y_offset
+        w, h = self.get_size()
+
+        f = get_scale_factor(self.scale)
+        return (x, y, w * f, h * f)
+
+    def get_copies(self, bounds, clip):
+        """ Return the rects where the object is drawn on its parent
+            to cover the clip area, each with the surface to draw there,
+            or None for the object's own surface.
+        """
+        return [(bounds, None)]
+
+    def is_visible(self, surface):
+        clip = surface.get_clip()
+        bounds = pygame.Rect(self.get_bounds())
+
+        for rect, source in self.get_copies(bounds, clip):
+            if rect.colliderect(clip):
+                return True
+
+        return False
+
     def fix_to(self, obj, border, offset=0, fixed=False):
         r"""Fix the border of self to the border of another object.
-        The position is updated when the tick method is called.
+        The position is updated whenever the other object moves.
         """
         w, h = self.get_size()
         ow, oh = obj.get_size()
@@ -515,7 +715,28 @@ class Image (Object):
             raise ValueError("'border' value must be 'left', 'right',"
                              " 'top' or 'bottom'.")
 
+        # stop following the previous object
+        if self.fixed_to:
+            self.fixed_to[0].followers.remove(self)
+
         self.fixed_to = (obj, (x, y))
+        obj.followers.append(self)
+
+        self.follow()
+
+    def follow(self):
+        """ Move the object to its place next to the object it is fixed to """
+        obj, pos = self.fixed_to
+        sx, sy = self.get_pos()
+        ox, oy = obj.get_pos()
+        x = ox + pos[0] if pos[0] is not None else sx
+        y = oy + pos[1] if pos[1] is not None else sy
+
+        self.set_pos((x, y))
+
+    def move_followers(self):
+        for obj in self.followers:
+            obj.follow()
 
     # NOTE : recursive
     def check_force(self):
@@ -524,11 +745,30 @@ class Image (Object):
                 obj.check_force()
 
                 try:
-                    if obj.force:
-                        self.force = True
+                    if obj.force or obj.force_children:
+                        self.force_children = True
                 except AttributeError:
                     pass
 
+    # NOTE : recursive
+    def execute(self):
+        # build the lazy children shown on the object,
+        # so that their scripts run before they are drawn
+        area = pygame.Rect((0, 0), self.get_size())
+        for obj in self.objects.values():
+            if (not getattr(obj, "loaded", True) and obj.display
+            and area.colliderect(obj.get_bounds())):
+                obj.activate()
+
+        Object.execute(self)
+
+    # NOTE : recursive
+    def set_redraw(self):
+        """ Render everything again, the colors of the buffers changed """
+        self.force = True
+        self.redraw = True
+        Object.set_redraw(self)
+
     def check_focus(self, mouse_pos):
         mx, my = mouse_pos
         x, y, w, h = self.get_rect()
@@ -573,30 +813,59 @@ class Image (Object):
             for obj in self.objects.values():
                 obj.update_state(mouse_but)
 
-    def tick(self, time):
-        Object.tick(self, time)
-
-        # position update
-        if self.fixed_to:
-            obj, pos = self.fixed_to
-            sx, sy = self.get_pos()
-            ox, oy = obj.get_pos()
-            x = ox + pos[0] if pos[0] is not None else sx
-            y = oy + pos[1] if pos[1] is not None else sy
+    def set_frames(self, frames, frame):
+        """ Animate the object with a dict of animation clips,
+            starting with the clip named "frame".
+        """
+        self.frames = frames
+        self.frame = None
+        self.play(frame)
+
+    def play(self, frame):
+        """ Switch to another animation clip """
+        if frame != self.frame:
+            self.frame = frame
+            self.frame_playing = frame
+            self.frame_index = 0
+            self.force = True
 
-            self.set_pos((x, y))
+            self.schedule()
+
+    def schedule(self):
+        """ Ask the scheduler to show the next frame when it is due """
+        global SCHEDULER
+        clip = self.frames[self.frame]
+        due = self.last_tick + clip.get_delay(self.frame_index)
+        self.frame_timer = SCHEDULER.add(self, due)
+
+    def next_frame(self, time):
+        """ Show the next frame, called by the scheduler when it is due """
+        # start the clip over when the animation changed
+        if self.frame != self.frame_playing:
+            self.frame_playing = self.frame
+            self.frame_index = 0
+
+        # check if the time spent exceeded the frame delay
+        clip = self.frames[self.frame]
+        if time - self.last_tick > clip.get_delay(self.frame_index):
+            self.frame_index = clip.get_next(self.frame_index)
+            self.force = True
 
-        # animation update
-        if self.frames:
-            # check if the time spent exceeded the frame delay
-            if time - self.last_tick > self.frames[self.frame].delay:
-                self.frames[self.frame].next()
-                self.force = True
+            self.last_tick = time
 
-                self.last_tick = time
+        self.schedule()
 
     def refresh(self):
         """ Refresh surface buffer with the original object's image """
+        # the frame is blitted straight from the image
+        if self.get_frame() is not None:
+            self.surface = None
+            self.drawn = (self.image, self.get_frame_pos())
+
+            self.force = False
+            self.redraw = False
+            return
+
         if self.surface is None:
             self.init_surface(self.get_size())
         else:
@@ -605,23 +874,77 @@ class Image (Object):
             else:
                 self.surface.clear()
 
-        if self.image:
-            # define rect
-            try:
-                x, y = self.frames[self.frame].rect
-            except KeyError:
-                x, y = 0, 0
+        self.draw_image()
 
-            iw, ih = self.image.get_size()
-            if self.h_mode == "mirrored" and self.h_mirrored:
-                x += iw / 2
-            if self.v_mode == "mirrored" and self.v_mirrored:
-                y += ih / 2
+        self.force = False
+        self.redraw = False
 
+    def draw_image(self):
+        """ Blit the current frame of the image on the surface buffer """
+        pos = self.get_frame_pos()
+        if self.image:
             # blit the image on the buffer
+            x, y = pos
             self.surface.blit(self.image, (-x, -y))
 
-        self.force = False
+        self.drawn = (self.image, pos)
+
+    def get_frame_pos(self):
+        """ Return the position of the current frame on the image """
+        if not self.image:
+            return None
+
+        # define rect
+        try:
+            clip = self.frames[self.frame]
+        except KeyError:
+            x, y = 0, 0
+        else:
+            if self.frame == self.frame_playing:
+                x, y = clip.get_rect(self.frame_index)
+            else:
+                x, y = clip.get_rect(0)
+
+        iw, ih = self.image.get_size()
+        if self.h_mode == "mirrored" and self.h_mirrored:
+            x += iw / 2
+        if self.v_mode == "mirrored" and self.v_mirrored:
+            y += ih / 2
+
+        return (x, y)
+
+    def get_frame(self):
+        """ Return the current frame as a slice of the image, if the object
+            can be drawn without a surface buffer, that is if it has
+            no children, no scaling, and the frame fits in the image.
+        """
+        if self.objects or self.layer or self.scale or not self.image:
+            return None
+
+        x, y = self.get_frame_pos()
+        w, h = self.get_size()
+        try:
+            return self.image.get_slice((x, y, w, h))
+        except (AttributeError, ValueError):  # not a Fxp.Surface, too big
+            return None
+
+    def is_outdated(self):
+        """ Check if the surface buffer does not show the current image.
+            Unlike "force", moving the object does not make it outdated.
+        """
+        if self.redraw:
+            return True
+
+        # objects without buffer only need to know what they show
+        if self.get_frame() is None:
+            if self.surface is None:
+                return True
+
+            if self.surface.get_size() != self.get_size():
+                return True
+
+        image, pos = self.drawn
+        return image is not self.image or pos != self.get_frame_pos()
 
     # NOTE : recursive
     def render(self, surface):
@@ -630,153 +953,816 @@ class Image (Object):
             if self.image is None:
                 self.load()
 
-            # check if refresh is forced
-            if(self.surface is None
-            or self.force):
+            # skip the object if it is outside of the parent
+            if not self.is_visible(surface):
+                self.last_bounds = None
+                return
+
+            # lazy objects are built when they are first shown
+            self.activate()
+
+            # check if refresh is needed
+            # moving the object alone does not change its buffer
+            refresh = self.force_children or self.is_outdated()
+            if refresh:
                 self.refresh()
 
             # render objects
-            for obj in self.get_sorted_children():
-                obj.render(self.surface)
+            # layers keep them on their buffer until something changes
+            if refresh or not self.layer:
+                for obj in self.get_sorted_children():
+                    obj.render(self.surface)
 
-            # apply offset
-            x = self.x + self.x_offset
-            y = self.y + self.y_offset
+                if self.scale:
+                    self.update_scaled()
 
-            # apply scaling method
-            if self.scale == "scale2x":
-                temp = pygame.transform.scale2x(self.surface)
-            elif self.scale == "simple":
-                temp = pygame.transform.scale(self.surface,
-                                              (self.w * 2, self.h * 2))
-            else:
-                temp = self.surface
+            self.force = False
+            self.force_children = False
 
             # blit surface on the parent
-            surface.blit(temp, (x, y))
+            self.last_bounds = pygame.Rect(self.get_bounds())
+            self.blit_on(surface)
+        else:
+            self.last_bounds = None
 
+    def blit_on(self, surface):
+        """ Blit the surface buffer where it was last rendered """
+        if self.last_bounds is None:
+            return
 
-class Frame:
-    def __init__(self, animation=[(0, (0, 0))]):
-        self.animation = animation
+        # the object is outside of the area being drawn
+        clip = surface.get_clip()
+        copies = [(rect, source) for rect, source
+                  in self.get_copies(self.last_bounds, clip)
+                  if clip.colliderect(rect)]
+        if not copies:
+            return
 
-        self.delay = animation[0][0]
-        self.rect = animation[0][1]
+        # the scaled buffer is kept up to date with the surface buffer
+        if self.scale:
+            temp = self.scaled
+        elif self.surface is None:
+            temp = self.get_frame()
+        else:
+            temp = self.surface
 
-        self.iterator = 0
+        # blit surface on the parent
+        for rect, source in copies:
+            surface.blit(temp if source is None else source, rect.topleft)
 
-    def next(self):
-        self.iterator += 1
-        if self.iterator >= len(self.animation):
-            self.iterator = 0
+    # NOTE : recursive
+    def update_dirty(self, surface):
+        """ Bring the surface buffer up to date, redrawing only
+            the areas that changed since the last frame.
 
-        self.delay = self.animation[self.iterator][0]
-        self.rect = self.animation[self.iterator][1]
+            Return the rects that must be redrawn on the parent's surface.
+        """
+        clip = surface.get_clip()
+        old = self.last_bounds
+        gone = self.spread([old], old, clip) if old is not None else []
 
+        if not self.display:
+            self.last_bounds = None
+            return gone
 
-class MovingObject (Image):
-    def __init__(self, name, filename=None):
-        Image.__init__(self, name, filename)
+        # prepare surface
+        if self.image is None:
+            self.load()
 
-        # movement
-        self.const_vectors = {}
-        self.temp_vectors = {}
-        self.velocity = None
-        self.fixed = False
+        # skip the object if it is outside of the parent
+        if not self.is_visible(surface):
+            self.last_bounds = None
+            return gone
 
-        # transitions
-        self.transitions = []
+        # lazy objects are built when they are first shown
+        self.activate()
 
-        # collisions
-        self.solid = False
-        self.mass = 0
-        self.hitboxes = []
+        # objects only change on screen when they move by a whole pixel
+        bounds = pygame.Rect(self.get_bounds())
+        self.last_bounds = bounds
 
-    def make_movable(self, polar=(0, 0)):
-        self.velocity = Vector("move", polar)
+        if self.is_outdated():
+            # the object itself changed, redraw everything
+            self.refresh()
+            for obj in self.get_sorted_children():
+                obj.render(self.surface)
 
-    def add_const_vector(self, vector):
-        if not vector.name in self.const_vectors.keys():
-            self.const_vectors[vector.name] = vector
+            if self.scale:
+                self.update_scaled()
 
-    def get_const_vector(self, name):
-        if name in self.const_vectors.keys():
-            return self.const_vectors[name]
+            rects = [bounds]
+        elif self.surface is None:
+            # the object is blitted straight from its image
+            rects = []
+        else:
+            # get the areas changed by the children
+            area = self.surface.get_rect()
+            changes = []
+            for obj in self.get_sorted_children():
+                for rect in obj.update_dirty(self.surface):
+                    rect = area.clip(rect)
+                    if rect.w and rect.h:
+                        changes.append(rect)
+
+            # too many changes, redraw everything
+            total = sum([rect.w * rect.h for rect in changes])
+            if total > area.w * area.h * self.dirty_ratio:
+                changes = [area]
+
+            # redraw the changed areas
+            for rect in changes:
+                self.surface.set_clip(rect)
+                self.surface.clear()
+                self.draw_image()
+                for obj in self.get_sorted_children():
+                    obj.blit_on(self.surface)
+            self.surface.set_clip(None)
+
+            # scale2x changes the pixels around a changed pixel as well,
+            # so the areas grow by one pixel for each pass
+            if self.scale and self.scale.startswith("scale"):
+                passes = get_scale_factor(self.scale) / 2
+                changes = [rect.inflate(passes * 2, passes * 2).clip(area)
+                           for rect in changes]
+
+            # scale only the changed areas
+            if self.scale:
+                self.update_scaled(changes)
+
+            # convert the areas to the parent's coordinates
+            x, y = bounds.topleft
+            f = get_scale_factor(self.scale)
+            rects = [(x + r.x * f, y + r.y * f, r.w * f, r.h * f)
+                     for r in changes]
 
-    def add_temp_vector(self, vector):
-        if not vector.name in self.temp_vectors.keys():
-            self.temp_vectors[vector.name] = vector
+        self.force = False
+        self.force_children = False
 
-    def get_temp_vector(self, name):
-        if name in self.temp_vectors.keys():
-            return self.temp_vectors[name]
+        # the object moved, both its old and new places changed
+        if old != bounds:
+            return gone + self.spread([bounds], bounds, clip)
 
-    def apply_vector(self, vector):
-        if vector.enable:
-            self.velocity += vector
+        return self.spread(rects, bounds, clip)
 
-    def apply_all_vectors(self):
-        for vector in self.const_vectors.values():
-            self.apply_vector(vector)
+    def spread(self, rects, bounds, clip):
+        """ Repeat rects of the parent's surface, given for the object
+            drawn at "bounds", on every copy of the object.
+        """
+        copies = self.get_copies(bounds, clip)
+        if len(copies) == 1 and copies[0][0] == bounds:
+            return rects
 
-        for vector in self.temp_vectors.values():
-            self.apply_vector(vector)
-        self.temp_vectors = {}
+        spread = []
+        for copy, source in copies:
+            dx = copy.x - bounds.x
+            dy = copy.y - bounds.y
+            spread += [pygame.Rect(rect).move(dx, dy) for rect in rects]
 
-    def move(self, vector=None):
-        if not vector:
-            vector = self.velocity
+        return spread
 
-        if(vector and not self.fixed):
-            # change the position of the object
-            if vector.enable:
-                x, y = vector.get_pos()
+    # NOTE : recursive
+    def compose(self, blits, x, y, clip):
+        """ Add the blits drawing the object and its children
+            straight on the target surface, without surface buffers.
 
-                # apply movement
-                self.x += x
-                self.y += y
-                self.force = True
+            "x" and "y" are the position of the parent on the target,
+            and "clip" the area of the target the parent can draw on.
+        """
+        if not self.display:
+            return
 
-    # NOTE : recursive
-    def move_all(self, vectors=True, move=True):
-        for obj in self.objects.values():
-            obj.move_all(vectors, move)
+        # prepare image
+        if self.image is None:
+            self.load()
 
-        if vectors:
-            self.apply_all_vectors()
+        # get the absolute rects of the object and its copies
+        rect = pygame.Rect(self.get_bounds()).move(x, y)
+        copies = [(copy, source) for copy, source
+                  in self.get_copies(rect, clip)
+                  if clip.colliderect(copy)]
 
-        if move:
-            self.move()
+        # lazy objects are built when they are first shown
+        if copies:
+            self.activate()
 
-    def transition(self, type, direction, distance, duration):
-        # TODO : BAD
-        # get starting point
-        start = x, y = self.get_pos()
+        if self.layer or self.scale:
+            # skip the object if it is outside of the parent
+            if not copies:
+                return
 
-        # get ending point
-        angle = 0.0
-        if(direction == "left"
-        or direction == "right"):
-            end = x + distance, y
-        elif(direction == "up"
-        or direction == "down"):
-            end = x, y + distance
+            # draw the object on its own surface buffer
+            if self.force_children or self.is_outdated():
+                self.refresh()
+                buffer_blits = []
+                for obj in self.get_sorted_children():
+                    obj.compose(buffer_blits, 0, 0, self.surface.get_rect())
+                blit_all(self.surface, buffer_blits)
 
-        # create vector
-        vector = Vector().set_pos()
-        self.transitions.append((type, vector))
+                if self.scale:
+                    self.update_scaled()
 
+            self.force = False
+            self.force_children = False
 
-class Camera (MovingObject):
-    def __init__(self, name):
-        MovingObject.__init__(self, name)
+            if self.scale:
+                temp = self.scaled
+            else:
+                temp = self.surface
+
+            for copy, source in copies:
+                visible = copy.clip(clip)
+                blits.append((temp if source is None else source,
+                              visible.topleft,
+                              visible.move(-copy.x, -copy.y)))
+        else:
+            # changes are drawn every time, nothing to refresh
+            self.force = False
+            self.force_children = False
+
+            for copy, source in copies:
+                visible = copy.clip(clip)
+
+                # draw the extension of the object
+                if source is not None:
+                    blits.append((source, visible.topleft,
+                                  visible.move(-copy.x, -copy.y)))
+                    continue
+
+                # draw the visible part of the current frame
+                if self.image:
+                    fx, fy = self.get_frame_pos()
+                    blits.append((self.image, visible.topleft,
+                                  visible.move(fx - copy.x, fy - copy.y)))
+
+                # draw the children, clipped to the object
+                for obj in self.get_sorted_children():
+                    obj.compose(blits, copy.x, copy.y, visible)
+
+    def update_scaled(self, rects=None):
+        """ Scale areas of the surface buffer on the scaled buffer,
+            all of it by default, or if the scaled buffer must be created """
+        f = get_scale_factor(self.scale)
+        w, h = self.surface.get_size()
+        if self.scaled is None or self.scaled.get_size() != (w * f, h * f):
+            self.scaled = Surface((w * f, h * f))
+            self.scaled.copy_palette(self.surface)
+            rects = None
+
+        if rects is None:
+            rects = [self.surface.get_rect()]
+
+        for rect in rects:
+            scale_surface(self.surface, self.scaled, self.scale, rect)
+
+    def render_flat(self, surface):
+        """ Render the object and its children straight on the surface.
+            Only layers and scaled objects use their surface buffer.
+        """
+        blits = []
+        self.compose(blits, 0, 0, surface.get_clip())
+        blit_all(surface, blits)
+
+    def render_dirty(self, surface):
+        """ Render only what changed since the last frame.
+            Return the updated rects of the surface.
+        """
+        rects = [pygame.Rect(rect) for rect in self.update_dirty(surface)]
+
+        # the rest of the surface is already up to date,
+        # so blitting once on the whole changed area is enough
+        if rects:
+            surface.set_clip(pygame.Rect(rects[0]).unionall(rects[1:]))
+            self.blit_on(surface)
+            surface.set_clip(None)
+
+        return rects
+
+
+class Frame:
+    """ Animation clip, made of the delay and position of each frame.
+
+        A clip is never modified, so the same one can be shared
+        by any number of objects. Each object keeps its own position
+        in the clip (see Image.frame_index).
+    """
+    def __init__(self, animation=[(0, (0, 0))]):
+        self.animation = tuple((delay, tuple(rect))
+                               for delay, rect in animation)
+
+    def get_delay(self, index):
+        return self.animation[index][0]
+
+    def get_rect(self, index):
+        return self.animation[index][1]
+
+    def get_next(self, index):
+        index += 1
+        if index >= len(self.animation):
+            index = 0
+
+        return index
+
+
+class Scheduler:
+    """ Timers of the animated objects, sorted by due time.
+
+        Each animated object has a timer for its next frame, so only
+        the objects whose frame is due are touched on each refresh,
+        however many animated objects are waiting.
+    """
+    def __init__(self):
+        self.timers = []  # heap of (due time, timer id, object reference)
+        self.count = 0
+
+    def add(self, obj, due):
+        """ Add a timer calling obj.next_frame() after the due time.
+            Return the id of the timer, which replaces any previous one
+            of the object.
+        """
+        self.count += 1
+        heapq.heappush(self.timers, (due, self.count, weakref.ref(obj)))
+
+        return self.count
+
+    def run(self, time):
+        """ Call the timers that are due """
+        while self.timers and self.timers[0][0] < time:
+            due, timer, ref = heapq.heappop(self.timers)
+
+            # skip the timers of deleted objects and replaced timers
+            obj = ref()
+            if obj is not None and obj.frame_timer == timer:
+                obj.next_frame(time)
+
+SCHEDULER = Scheduler()
+
+
+class Scenes:
+    """ Cache of the scene trees, which are built in the background.
+
+        A scene is built by a generator, yielding None after each step
+        and the root object at the end. The steps of the scenes being
+        preloaded are run between the frames, within a time budget, so
+        that the scene shown keeps running. The steps must be short for
+        that. When the cache is full, the least recently used scene is
+        dropped.
+
+        A scene failing to build in the background is dropped, and the
+        error is raised again when the scene is loaded.
+
+        A scene loaded from the cache is the same tree as when it was
+        left, whoever loads it resets what must not be kept.
+    """
+    def __init__(self, size=2, budget=5):
+        self.scenes = collections.OrderedDict()  # name -> root object
+        self.size = size
+
+        # scenes being built, and milliseconds spent on them per frame
+        self.building = collections.OrderedDict()  # name -> generator
+        self.budget = budget
+
+        # errors of the scenes that failed to build in the background,
+        # with their traceback
+        self.errors = {}  # name -> (type, value, traceback)
+
+    def preload(self, name, build):
+        """ Start building a scene in the background """
+        if not name in self.scenes and not name in self.building:
+            self.errors.pop(name, None)
+            self.building[name] = build()
+
+    def load(self, name, build):
+        """ Return a scene, and finish building it now if needed """
+        if name in self.errors:
+            type, value, traceback = self.errors.pop(name)
+            raise type, value, traceback
+
+        self.preload(name, build)
+
+        # the scene is being built, run all the remaining steps
+        if name in self.building:
+            for root in self.building.pop(name):
+                pass
+            self.add(name, root)
+
+        # the most recently used scenes are at the end
+        root = self.scenes.pop(name)
+        self.scenes[name] = root
+
+        return root
+
+    def add(self, name, root):
+        self.scenes[name] = root
+
+        # forget the least recently used scenes
+        while len(self.scenes) > self.size:
+            name, root = self.scenes.popitem(last=False)
+            root.release_all()
+
+    def drop(self, name):
+        """ Forget a scene, built or not """
+        root = self.scenes.pop(name, None)
+        if root is not None:
+            root.release_all()
+
+        steps = self.building.pop(name, None)
+        if steps is not None:
+            steps.close()
+
+    def run(self):
+        """ Run building steps until the time budget is spent """
+        start = pygame.time.get_ticks()
+        while self.building:
+            name, steps = next(self.building.iteritems())
+            try:
+                root = next(steps)
+            except StopIteration:
+                # the generator ended without a root
+                self.building.pop(name)
+                continue
+            except Exception:
+                # the scene shown keeps running
+                self.building.pop(name)
+                self.errors[name] = sys.exc_info()
+                continue
+
+            if root is not None:
+                self.building.pop(name)
+                self.add(name, root)
+
+            if pygame.time.get_ticks() - start >= self.budget:
+                break
+
+
+class Zones:
+    """ Streaming of the zones of a dimension.
+
+        The current zone is active, and the zones next to it are built
+        step by step in the background, within a time budget per frame,
+        so that walking through a portal needs no loading. When the zones
+        built use more memory than the budget, the least recently used ones
+        that are not around the current zone are unloaded.
+    """
+    def __init__(self, root, memory=16777216, budget=5):  # 16 MiB
+        # zones of the dimension by name
+        self.zones = dict((obj.name, obj) for obj in root.objects.values()
+                          if isinstance(obj, Zone))
+        self.current = None
+
+        # zones waiting to be built, the steps of the one being built,
+        # and milliseconds spent on them per frame
+        self.queue = collections.deque()
+        self.steps = None
+        self.budget = budget
+
+        # portal the object given to update is in
+        self.portal = None
+
+        # memory used by the zones built, the most recently used at the end
+        self.loaded = collections.OrderedDict()  # name -> memory
+        self.memory = memory
+
+        # statistics
+        self.hits = 0  # zones entered that were built already
+        self.misses = 0  # zones entered that had to be built
+        self.preloads = 0
+        self.unloads = 0
+
+        # enter the starting zone of the dimension
+        try:
+            type, name = root.data["config"]["starting_zone"]
+        except KeyError:
+            name = None
+
+        if name in self.zones:
+            self.enter(name)
+
+    def get_neighbours(self):
+        """ Return the names of the zones next to the current one """
+        if self.current is None:
+            return []
+
+        return [name for name in self.zones[self.current].get_neighbours()
+                if name in self.zones]
+
+    def get_memory(self, zone):
+        """ Return the memory used by the images of a zone and its children """
+        surfaces = {}
+        found = [zone]
+        while found:
+            obj = found.pop()
+            for surface in (getattr(obj, "image", None),
+                            getattr(obj, "surface", None)):
+                if surface is not None:
+                    surfaces[id(surface)] = get_surface_size(surface)
+
+            found += obj.objects.values()
+
+        return sum(surfaces.values())
+
+    def use(self, name):
+        # the most recently used zones are at the end
+        self.loaded.pop(name, None)
+        self.loaded[name] = self.get_memory(self.zones[name])
+
+    def enter(self, name):
+        """ Make a zone the current one, building it now if needed """
+        zone = self.zones[name]
+        if zone.loaded:
+            self.hits += 1
+        else:
+            self.misses += 1
+            zone.activate()
+
+        self.current = name
+        self.use(name)
+
+        # show the zones around only, the missing ones are built later
+        neighbours = self.get_neighbours()
+        for other in self.zones.values():
+            other.display = (other is zone
+                             or other.name in neighbours and other.loaded)
+
+        # a zone left half built is finished when it is activated
+        self.queue = collections.deque(n for n in neighbours
+                                       if not self.zones[n].loaded)
+        self.steps = None
+        self.trim()
+
+    def get_portal(self, obj):
+        """ Return the portal of the current zone the object is in """
+        zone = self.zones[self.current]
+        zx, zy = zone.get_pos()
+        rect = pygame.Rect(obj.get_rect())
+
+        for portal in zone.get_portals():
+            if rect.colliderect(pygame.Rect(portal.get_rect()).move(zx, zy)):
+                return portal
+
+        return None
+
+    def update(self, obj):
+        """ Enter the zone behind the portal an object walks through.
+            The object is a child of the dimension, like the zones.
+        """
+        if self.current is None:
+            return
+
+        # only entering a portal goes through it, not staying in it
+        portal = self.get_portal(obj)
+        if portal is None or portal is self.portal:
+            self.portal = portal
+            return
+
+        name = portal.get_zone()
+        if name in self.zones:
+            self.enter(name)
+
+            # put the object at the arrival of the portal
+            arrival = portal.get_arrival()
+            if arrival:
+                x, y = arrival
+                nx, ny = self.zones[name].get_pos()
+                obj.set_pos((nx + x, ny + y))
+
+            # arriving in a portal does not go through it
+            portal = self.get_portal(obj)
+
+        self.portal = portal
+
+    def run(self):
+        """ Build the zones next to the current one
+            until the time budget is spent
+        """
+        if not self.queue:
+            return
+
+        start = pygame.time.get_ticks()
+        built = False
+        while self.queue:
+            name = self.queue[0]
+            zone = self.zones[name]
+            if zone.loaded:
+                self.queue.popleft()
+                continue
+
+            if self.steps is None:
+                self.steps = zone.activate_steps()
+
+            try:
+                next(self.steps)
+            except StopIteration:
+                self.queue.popleft()
+                self.steps = None
+
+                zone.display = True
+                self.use(name)
+                self.preloads += 1
+                built = True
+
+            if pygame.time.get_ticks() - start >= self.budget:
+                break
+
+        if built:
+            self.trim()
+
+    def trim(self):
+        """ Unload the zones far from the current one,
+            until the memory budget is respected
+        """
+        keep = set([self.current] + self.get_neighbours())
+        memory = sum(self.loaded.values())
+
+        for name, size in self.loaded.items():
+            if memory <= self.memory:
+                break
+
+            if not name in keep:
+                zone = self.zones[name]
+                zone.unload()
+                zone.display = False
+
+                del self.loaded[name]
+                memory -= size
+                self.unloads += 1
+
+
+class MovingObject (Image):
+    def __init__(self, name, filename=None):
+        Image.__init__(self, name, filename)
+
+        # movement
+        self.const_vectors = {}
+        self.temp_vectors = {}
+        self.velocity = None
+        self.fixed = False
+
+        # transitions
+        self.transitions = []
+
+        # collisions
+        self.solid = False
+        self.mass = 0
+        self.hitboxes = []
+
+    def make_movable(self, polar=(0, 0)):
+        self.velocity = Vector("move", polar)
+
+    def add_const_vector(self, vector):
+        if not vector.name in self.const_vectors.keys():
+            self.const_vectors[vector.name] = vector
+
+    def get_const_vector(self, name):
+        if name in self.const_vectors.keys():
+            return self.const_vectors[name]
+
+    def add_temp_vector(self, vector):
+        if not vector.name in self.temp_vectors.keys():
+            self.temp_vectors[vector.name] = vector
+
+    def get_temp_vector(self, name):
+        if name in self.temp_vectors.keys():
+            return self.temp_vectors[name]
+
+    def apply_vector(self, vector):
+        if vector.enable:
+            self.velocity += vector
+
+    def apply_all_vectors(self):
+        for vector in self.const_vectors.values():
+            self.apply_vector(vector)
+
+        for vector in self.temp_vectors.values():
+            self.apply_vector(vector)
+        self.temp_vectors = {}
+
+    def move(self, vector=None):
+        if not vector:
+            vector = self.velocity
+
+        if(vector and not self.fixed):
+            # change the position of the object
+            if vector.enable:
+                x, y = vector.get_pos()
+                self.shift(x, y)
+
+    def shift(self, x, y):
+        """ Apply a movement to the object """
+        if x or y:
+            self.x += x
+            self.y += y
+            self.force = True
+
+            self.move_followers()
+
+    # NOTE : recursive
+    def move_all(self, vectors=True, move=True):
+        for obj in self.objects.values():
+            obj.move_all(vectors, move)
+
+        if vectors:
+            self.apply_all_vectors()
+
+        if move:
+            self.move()
+
+    def transition(self, type, direction, distance, duration):
+        # TODO : BAD
+        # get starting point
+        start = x, y = self.get_pos()
+
+        # get ending point
+        angle = 0.0
+        if(direction == "left"
+        or direction == "right"):
+            end = x + distance, y
+        elif(direction == "up"
+        or direction == "down"):
+            end = x, y + distance
+
+        # create vector
+        vector = Vector().set_pos()
+        self.transitions.append((type, vector))
+
+
+class Camera (MovingObject):
+    def __init__(self, name):
+        MovingObject.__init__(self, name)
 
         self.active = True
         self.target = None
         self.loose = 512
 
+        # parallax layers of background objects
+        self.layers = {}
+
+        # parallax factor of each child, None when it must be computed
+        # again: the target, the children or their priority changed
+        self.parallax = None
+
         self.fixed = True
 
+    def add_background(self, obj):
+        """ Add a background object to the layer sharing its parallax
+            factor and scrolling, creating the layer if needed.
+        """
+        key = (obj.z, obj.h_mode, obj.v_mode, obj.get_size(),
+               getattr(obj, "extension_color", None))
+        if key not in self.layers:
+            layer = Layer("layer{}".format(len(self.layers)))
+            layer.z = obj.z
+            self.layers[key] = layer
+            self.add_child(layer)
+
+        # make the position relative to the layer
+        layer = self.layers[key]
+        x, y = obj.get_pos()
+        lx, ly = layer.get_pos()
+        obj.set_pos((x - lx, y - ly))
+
+        layer.add_child(obj)
+
+    def add_child(self, obj):
+        MovingObject.add_child(self, obj)
+        self.parallax = None
+
+    def remove_child(self, name):
+        self.parallax = None
+        return MovingObject.remove_child(self, name)
+
+    def set_target(self, target):
+        """ Follow an object """
+        self.target = target
+        self.parallax = None
+
+    def set_priority(self, obj, z):
+        """ Change the priority of a child, the target or the camera,
+            which changes the parallax of the children """
+        obj.z = z
+        self.parallax = None
+
+    def get_parallax(self):
+        """ Return the children with the factor applied to the camera
+            movement for each, computed again only when the target,
+            the children or their priority changed.
+        """
+        if self.parallax is not None:
+            return self.parallax
+
+        children = self.objects.values()
+        z_target = self.target.z if self.target else self.z
+        self.parallax = []
+        if children:
+            zs = [obj.z for obj in children]
+            priority_diff = max(zs) - min(zs)
+
+            # the further from the target, the slower the movement
+            for obj in children:
+                d = 1.0 + (obj.z - z_target) / (priority_diff + 1)
+                self.parallax.append((obj, d))
+
+        return self.parallax
+
     def update_vector(self):
         mx, my = self.get_center()
         cx, cy = self.target.get_center()
@@ -808,17 +1794,11 @@ class Camera (MovingObject):
                 x = self.velocity.x
                 y = self.velocity.y
 
-                # calculate vector distance modifier
-                def distance(z, z_target, priority_diff):
-                    return 1.0 + (z - z_target) / (priority_diff + 1)
-
-                children = self.get_sorted_children()
-                priority_diff = children[-1].z - children[0].z
-                if children:
-                    for child in children:
-                        d = distance(child.z, self.target.z, priority_diff)
-                        # apply camera vector
-                        child.move(self.velocity * d * speed)
+                # apply camera vector
+                if self.velocity.enable and (x or y):
+                    for child, d in self.get_parallax():
+                        if not child.fixed:
+                            child.shift(x * d * speed, y * d * speed)
 
         # move children and self
         MovingObject.move_all(self, vectors, move)
@@ -828,34 +1808,18 @@ class Background (MovingObject):
     def __init__(self, name, filename=None):
         MovingObject.__init__(self, name, filename)
 
+        # solid color drawn beyond the borders of an extended image
+        self.extension_color = None
+        self.extension = None
+
     def duplicate(self, horizontal=True):
         # if the image is not set, we quit
         if not self.image:
             return
 
-        # get the corresponding dimension
-        if horizontal:
-            w = self.w * 2
-            h = self.h
-        else:
-            w = self.w
-            h = self.h * 2
-
-        # create a new surface
-        temp = Surface((w, h))
-
-        # blit self image on the new surface
-        temp.blit(self.image, (0, 0))
-        if horizontal:
-            temp.blit(self.image, (self.w, 0))
-        else:
-            temp.blit(self.image, (0, self.h))
-
         # apply the new surface
-        self.image = temp
-        self.surface = None
-        self.w = w
-        self.h = h
+        self.transform(("duplicate", horizontal))
+        self.w, self.h = self.image.get_size()
 
         if horizontal:
             self.h_mode = "duplicated"
@@ -876,44 +1840,173 @@ class Background (MovingObject):
             angle = 0.5
             horizontal = False
 
-        self.duplicate(horizontal)
+        self.wrap(horizontal)
         self.make_movable((speed, angle))
 
+    def wrap(self, horizontal=True):
+        """ Repeat the image endlessly along an axis.
+            Unlike duplicate(), the image is kept as it is,
+            and only the visible part of each repetition is drawn.
+        """
+        if horizontal:
+            self.h_mode = "wrapped"
+        else:
+            self.v_mode = "wrapped"
+
+        self.force = True
+
     def extend(self, color, horizontal=True):
-        pass  # TODO
+        """ Fill everything beyond the borders of the image
+            along an axis with a solid color.
+        """
+        self.extension_color = color
+        self.extension = None
 
-    def move(self, vector=None):
-        MovingObject.move(self, vector)
+        if horizontal:
+            self.h_mode = "extended"
+        else:
+            self.v_mode = "extended"
 
-        if not vector:
-            vector = self.velocity
+        self.force = True
+
+    def get_copies(self, bounds, clip):
+        xs = self.get_repetitions(self.h_mode, bounds.x, bounds.w,
+                                  clip.x, clip.right)
+        ys = self.get_repetitions(self.v_mode, bounds.y, bounds.h,
+                                  clip.y, clip.bottom)
+
+        copies = []
+        for y, y_image in ys:
+            for x, x_image in xs:
+                rect = pygame.Rect(x, y, bounds.w, bounds.h)
+                if x_image and y_image:
+                    copies.append((rect, None))
+                else:
+                    copies.append((rect, self.get_extension(rect.size)))
+
+        return copies
+
+    def get_repetitions(self, mode, pos, size, start, end):
+        """ Return the positions of the repetitions of the object
+            along an axis between "start" and "end", each telling
+            if the image is drawn there or the extension color.
+        """
+        if mode not in ("wrapped", "extended") or size <= 0:
+            return [(pos, True)]
+
+        first = start - (start - pos) % size
+        return [(p, mode == "wrapped" or p == pos)
+                for p in range(first, end, size)]
+
+    def get_extension(self, size):
+        """ Return a surface filled with the extension color """
+        if self.extension is None or self.extension.get_size() != size:
+            self.extension = Surface(size)
+            self.extension.fill(self.extension_color)
+
+        return self.extension
+
+    def shift(self, x, y):
+        MovingObject.shift(self, x, y)
+        sx, sy = self.x, self.y
 
         # horizontal scrolling
-        if self.h_mode:
+        period = self.get_period(self.h_mode, self.w)
+        if period:
             # check direction
-            if vector.x < 0:  # left
+            if x < 0:  # left
                 # shift background
-                if(self.x + self.w / 2 <= 0):
-                    self.x += self.w / 2
-            elif vector.x > 0:  # right
+                if(self.x + period <= 0):
+                    self.x += period
+            elif x > 0:  # right
                 # shift background
-                if(self.x + self.w / 2 >= self.w / 2):
-                    self.x -= self.w / 2
+                if(self.x >= 0):
+                    self.x -= period
 
         # vertical scrolling
-        if self.v_mode:
+        period = self.get_period(self.v_mode, self.h)
+        if period:
             # check direction
-            if vector.y < 0:  # left
+            if y < 0:  # up
                 # shift background
-                if(self.y + self.h / 2 <= 0):
-                    self.y += self.h / 2
-            elif vector.y > 0:  # right
+                if(self.y + period <= 0):
+                    self.y += period
+            elif y > 0:  # down
                 # shift background
-                if(self.y + self.h / 2 >= self.h / 2):
-                    self.y -= self.h / 2
+                if(self.y >= 0):
+                    self.y -= period
+
+        # the followers must be moved again
+        if (sx, sy) != (self.x, self.y):
+            self.move_followers()
+
+    def get_period(self, mode, size):
+        """ Return the distance after which a scrolling background
+            looks the same again, or 0 if it does not scroll.
+        """
+        if mode == "duplicated":
+            return size / 2
+        elif mode == "wrapped":
+            return size
+        else:
+            return 0
+
+
+class Layer (Background):
+    """ Background objects composited once on a single cached surface.
+
+        The members keep their position relative to the layer, which is
+        the only object moved by the camera. The surface is composited
+        again only when a member is added or changes.
+    """
+    def __init__(self, name):
+        Background.__init__(self, name)
+
+        self.layer = True
+        self.make_movable()
+
+    def add_child(self, obj):
+        # the layer scrolls like its members
+        if not self.objects:
+            self.h_mode = obj.h_mode
+            self.v_mode = obj.v_mode
+            self.extension_color = getattr(obj, "extension_color", None)
+
+        Background.add_child(self, obj)
+
+        self.update_size()
+        self.redraw = True
+
+    def update_size(self):
+        w, h = 0, 0
+        for obj in self.objects.values():
+            x, y, ow, oh = obj.get_rect()
+            w = max(w, x + ow)
+            h = max(h, y + oh)
+
+        self.set_size((w, h))
+
+    def check_force(self):
+        Background.check_force(self)
+
+        # members may have been moved by fix_to()
+        if self.force_children:
+            self.update_size()
 
 
 class Map (MovingObject):
+    # neighbours used to compute the rule of a tile
+    NEIGHBOURS = (
+        (0x80, (-1, -1)),  # upper-left
+        (0x40, (0, -1)),   # upper-middle
+        (0x20, (1, -1)),   # upper-right
+        (0x10, (-1, 0)),   # middle-left
+        (0x08, (1, 0)),    # middle-right
+        (0x04, (-1, 1)),   # bottom-left
+        (0x02, (0, 1)),    # bottom-middle
+        (0x01, (1, 1))     # bottom-right
+    )
+
     def __init__(self, name, tile_size, filename=None):
         MovingObject.__init__(self, name)
 
@@ -926,6 +2019,17 @@ class Map (MovingObject):
         self.tiles_w = 0
         self.tiles_h = 0
 
+        # tile variants
+        self.seed = None
+        self.noise = None
+
+        # collisions (tile -> hitbox covering it)
+        self.covered = None
+
+        # undo journal, one tuple of (x, y, old, new) per edit
+        # the oldest edits are dropped when it is full
+        self.journal = collections.deque(maxlen=256)
+
         if filename:
             self.load_from_file(filename)
 
@@ -980,16 +2084,57 @@ class Map (MovingObject):
         # get sizes
         self.tiles_h = len(self.tiles)
         self.tiles_w = max([len(line) for line in self.tiles])
+        self.noise = None
 
     def set_tile(self, value, pos, rel=(0, 0)):
         x, y = pos
         dx, dy = rel
 
-        if x + dx >= 0 and y + dy >= 0:
+        self.set_tiles([(value, (x + dx, y + dy))])
+
+    def set_tiles(self, changes, journal=True):
+        """ Change several tiles at once.
+
+            "changes" is a list of (value, (x, y)) tuples.
+            Only the neighbourhood of the changed tiles is baked again,
+            and only the hitboxes around them are rebuilt.
+        """
+        changed = []
+        for value, pos in changes:
+            x, y = pos
+            if x < 0 or y < 0:
+                continue
+
             try:
-                self.tiles[y + dy][x + dx] = value
+                old = self.tiles[y][x]
+                self.tiles[y][x] = value
             except IndexError:
-                return
+                continue
+
+            if old != value:
+                changed.append((x, y, old, value))
+
+        if not changed:
+            return
+
+        # record the edit
+        if journal:
+            self.journal.append(tuple(changed))
+
+        positions = [(x, y) for x, y, old, new in changed]
+        self.update_tiles(positions)
+        self.patch_collisions(positions)
+
+    def undo(self):
+        """ Revert the last edit. Return False if there is nothing to undo. """
+        if not self.journal:
+            return False
+
+        changes = self.journal.pop()
+        self.set_tiles([(old, (x, y)) for x, y, old, new in reversed(changes)],
+                       journal=False)
+
+        return True
 
     def get_tile(self, pos, rel=(0, 0)):
         x, y = pos
@@ -1008,18 +2153,8 @@ class Map (MovingObject):
 
         tile = self.get_tile(pos, (0, 0))  # get itself
 
-        # get other positions
-        positions = {
-            0x80: (-1, -1),  # upper-left
-            0x40: (0, -1),   # upper-middle
-            0x20: (1, -1),   # upper-right
-            0x10: (-1, 0),   # middle-left
-            0x08: (1, 0),    # middle-right
-            0x04: (-1, 1),   # bottom-left
-            0x02: (0, 1),    # bottom-middle
-            0x01: (1, 1)     # bottom-right
-        }
-        for val, p in positions.items():
+        # get other positions
+        for val, p in self.NEIGHBOURS:
             t = self.get_tile(pos, p)
             if t in self.mixables or t == tile:
                 rule += val
@@ -1030,122 +2165,270 @@ class Map (MovingObject):
     def set_void(self, name):
         self.void = name
 
+    def set_seed(self, seed):
+        """ Make the choice of tile variants reproducible """
+        self.seed = seed
+        self.noise = None
+
+    def get_noise(self):
+        """ Return the random value of each tile, used to pick its variant.
+            The values only depend on the seed, so a seeded map always
+            looks the same, whatever the way it is baked.
+        """
+        if self.noise is None:
+            generator = random.Random(self.seed)
+            self.noise = [[generator.getrandbits(16)
+                           for x in range(0, self.tiles_w)]
+                          for y in range(0, self.tiles_h)]
+
+        return self.noise
+
+    def release(self):
+        for tileset in self.tilesets.values():
+            tileset.release()
+
+        MovingObject.release(self)
+
     def add_tileset(self, tileset, mixable=True):
         self.tilesets[tileset.name] = tileset
         if mixable:
             self.mixables.append(self.header.index(tileset.name))
 
+    def is_solid(self, pos):
+        x, y = pos
+        if(x < 0 or x >= self.tiles_w
+        or y < 0 or y >= self.tiles_h):
+            return False
+
+        name = self.header[self.get_tile(pos)]
+        return name != self.void and self.tilesets[name].solid
+
     def update_collisions(self):
-        # nested utility function
-        # needed to place cursor at the right place
-        def is_tested(tile):
-            x, y = tile
-            for hitbox in self.hitboxes:
-                rx, ry, rw, rh = hitbox
-                rx /= self.tile_size
-                ry /= self.tile_size
-                rw /= self.tile_size
-                rh /= self.tile_size
-                if(x >= rx and x < rx + rw
-                and y >= ry and y < ry + rh):
-                    return True
+        for step in self.update_collisions_steps():
+            pass
 
-            return False
+    def update_collisions_steps(self):
+        """ Same as update_collisions, yielding None after each row """
+        self.hitboxes = []
+        self.covered = {}
+
+        # loop on each tile
+        for tile_y in range(0, self.tiles_h):
+            for tile_x in range(0, self.tiles_w):
+                self.add_hitbox((tile_x, tile_y))
+            yield None
+
+    def patch_collisions(self, positions):
+        """ Rebuild the hitboxes around the given tiles only """
+        # collisions were never computed
+        if self.covered is None:
+            return
+
+        # release the hitboxes covering the changed tiles
+        ts = self.tile_size
+        areas = []
+        for pos in positions:
+            x, y = pos
+            areas.append((x, y, 1, 1))
+
+            rect = self.covered.get(pos)
+            if rect is not None:
+                self.remove_hitbox(rect)
+
+                rx, ry, rw, rh = rect
+                areas.append((rx / ts, ry / ts, rw / ts, rh / ts))
+
+        # cover the released areas again
+        for x, y, w, h in areas:
+            for tile_y in range(y, y + h):
+                for tile_x in range(x, x + w):
+                    self.add_hitbox((tile_x, tile_y))
+
+    def add_hitbox(self, pos):
+        """ Create the largest hitbox starting from the given tile
+            if it is solid and not already covered.
+        """
+        def is_free(tile):
+            return tile not in self.covered and self.is_solid(tile)
+
+        if not is_free(pos):
+            return
 
-        tile_x = 0
-        tile_y = 0
-        x = 0
-        y = 0
+        tile_x, tile_y = pos
         w = 1
         h = 1
         h_end = False
         v_end = False
-        # loop on each tile
-        while tile_y < self.tiles_h:
-            tileset_id = self.get_tile((tile_x, tile_y))
-            name = self.header[tileset_id]
-            # start the creation of a new rectangle
-            if(name != self.void
-            and self.tilesets[name].solid
-            and not is_tested((tile_x, tile_y))):
-                x = tile_x
-                y = tile_y
-                while not (h_end and v_end):
-                    # test a horizontal line
-                    if not h_end:
-                        for cur_x in range(0, w):
-                            tile = (tile_x + cur_x, tile_y + h)
-                            cur_id = self.get_tile(tile)
-                            cur_name = self.header[cur_id]
-                            if(cur_name == self.void
-                            or not self.tilesets[cur_name].solid
-                            or is_tested(tile)):
-                                h_end = True
-                                break
-
-                    # if after the loop every tile was solid
-                    if not h_end:
-                        h += 1  # our rect is one tile larger
-
-                    # test a vertical line
-                    if not v_end:
-                        for cur_y in range(0, h):
-                            tile = (tile_x + w, tile_y + cur_y)
-                            cur_id = self.get_tile(tile)
-                            cur_name = self.header[cur_id]
-                            if(cur_name == self.void
-                            or not self.tilesets[cur_name].solid
-                            or is_tested(tile)):
-                                v_end = True
-                                break
-
-                    # if after the loop every tile was solid
-                    if not v_end:
-                        w += 1  # our rect is one tile larger
-
-                # create a new rectangle
-                ts = self.tile_size
-                rect = (x * ts, y * ts, w * ts, h * ts)
-                self.hitboxes.append(rect)
-                x = 0
-                y = 0
-                w = 1
-                h = 1
-                h_end = False
-                v_end = False
-
-            # move cursor
-            tile_x += w
-
-            if tile_x >= self.tiles_w:
-                tile_x = 0
-                tile_y += 1
+        while not (h_end and v_end):
+            # test a horizontal line
+            if not h_end:
+                for cur_x in range(0, w):
+                    if not is_free((tile_x + cur_x, tile_y + h)):
+                        h_end = True
+                        break
+
+            # if after the loop every tile was solid
+            if not h_end:
+                h += 1  # our rect is one tile larger
+
+            # test a vertical line
+            if not v_end:
+                for cur_y in range(0, h):
+                    if not is_free((tile_x + w, tile_y + cur_y)):
+                        v_end = True
+                        break
+
+            # if after the loop every tile was solid
+            if not v_end:
+                w += 1  # our rect is one tile larger
+
+        # create a new rectangle
+        ts = self.tile_size
+        rect = (tile_x * ts, tile_y * ts, w * ts, h * ts)
+        self.hitboxes.append(rect)
+
+        for y in range(tile_y, tile_y + h):
+            for x in range(tile_x, tile_x + w):
+                self.covered[(x, y)] = rect
+
+    def remove_hitbox(self, rect):
+        self.hitboxes.remove(rect)
+
+        ts = self.tile_size
+        rx, ry, rw, rh = rect
+        for y in range(ry / ts, (ry + rh) / ts):
+            for x in range(rx / ts, (rx + rw) / ts):
+                del self.covered[(x, y)]
 
     def load(self):
+        # bake the whole map at once if possible
+        sizes = [tileset.size for tileset in self.tilesets.values()]
+        if numpy is not None and sizes.count(self.tile_size) == len(sizes):
+            self.load_from_atlas()
+            return
+
         # create image
         self.image = Surface(self.get_size())
 
         # print tiles
-        x = 0
-        y = 0
         for tile_y in range(0, self.tiles_h):
             for tile_x in range(0, self.tiles_w):
-                # get tile and its rule
-                tileset_id = self.get_tile((tile_x, tile_y))
-                name = self.header[tileset_id]
-
-                # print tile
-                if name != self.void:
-                    rule = self.get_rule((tile_x, tile_y))
-                    self.image.blit(self.tilesets[name]
-                                    .get_tile_by_rule(rule), (x, y))
-                    x += self.tilesets[name].size
-                else:
-                    x += self.tile_size
+                self.bake_tile((tile_x, tile_y), clear=False)
+
+    def bake_tile(self, pos, clear=True):
+        # get tile and its destination
+        tile_x, tile_y = pos
+        ts = self.tile_size
+        x = tile_x * ts
+        y = tile_y * ts
+
+        if clear:
+            global PALETTE
+            self.image.fill(PALETTE.get_colorkey(), (x, y, ts, ts))
+
+        # print tile
+        name = self.header[self.get_tile(pos)]
+        if name != self.void:
+            rule = self.get_rule(pos)
+            variant = self.get_noise()[tile_y][tile_x]
+            tile = self.tilesets[name].get_tile_by_rule(rule, variant)
+            self.image.blit(tile, (x, y))
+
+    def load_from_atlas(self):
+        """ Bake the whole map with numpy instead of blitting tile by tile.
+
+            The rules of every tile are computed on the whole grid at once,
+            then the pixels are copied from the tilesets' atlases.
+            All the tilesets must have the same size as the map's tiles.
+        """
+        ts = self.tile_size
+        w = self.tiles_w
+        h = self.tiles_h
+
+        # tile ids, surrounded by a border of zeros like get_tile() does
+        ids = numpy.zeros((h + 2, w + 2), dtype=numpy.intp)
+        for y, line in enumerate(self.tiles):
+            ids[y + 1, 1:len(line) + 1] = line
+        tiles = ids[1:h + 1, 1:w + 1]
+
+        # compute the rules
+        count = max(len(self.header), ids.max() + 1)
+        mixable = numpy.zeros(count, dtype=bool)
+        mixable[self.mixables] = True
+
+        rules = numpy.zeros((h, w), dtype=numpy.intp)
+        for val, p in self.NEIGHBOURS:
+            dx, dy = p
+            other = ids[1 + dy:h + 1 + dy, 1 + dx:w + 1 + dx]
+            rules += val * (mixable[other] | (other == tiles))
+
+        # get the candidate atlas indices of every (tile id, rule)
+        # index 0 is an empty tile used for the void
+        self.image = Surface(self.get_size())
+        blank = numpy.empty((1, ts, ts), dtype=numpy.intp)
+        blank.fill(self.image.map_rgb(PALETTE.get_colorkey()))
+
+        atlases = [blank]
+        offset = 1
+        tables = []
+        for name in self.header + [None] * (count - len(self.header)):
+            if name == self.void or name not in self.tilesets:
+                tables.append([[0]] * 256)
+            else:
+                tileset = self.tilesets[name]
+                table = tileset.get_rule_table()
+                tables.append([[offset + i for i in candidates]
+                               for candidates in table])
+                atlases.append(tileset.get_atlas())
+                offset += len(tileset.tiles)
+
+        k = max([len(c) for table in tables for c in table])
+        choices = numpy.zeros((count, 256, k), dtype=numpy.intp)
+        counts = numpy.zeros((count, 256), dtype=numpy.intp)
+        for i, table in enumerate(tables):
+            for rule, candidates in enumerate(table):
+                choices[i, rule, :len(candidates)] = candidates
+                counts[i, rule] = len(candidates)
+
+        # pick a variant for every tile
+        noise = numpy.array(self.get_noise(), dtype=numpy.intp)
+        variants = noise % counts[tiles, rules]
+        index = choices[tiles, rules, variants]
+
+        # assemble the pixels, in the [x][y] order of surfarray
+        atlas = numpy.concatenate(atlases)
+        pixels = atlas[index.T].transpose(0, 2, 1, 3).reshape(w * ts, h * ts)
+
+        # copy them on the image
+        iw, ih = self.image.get_size()
+        cw = min(iw, w * ts)
+        ch = min(ih, h * ts)
+        target = pygame.surfarray.pixels2d(self.image)
+        target[:cw, :ch] = pixels[:cw, :ch]
+        del target  # unlock the surface
+
+    def update_tiles(self, positions):
+        """ Bake again the given tiles and their neighbours,
+            whose rules may have changed.
+        """
+        # nothing baked yet
+        if self.image is None:
+            return
 
-            # new line
-            x = 0
-            y += self.tile_size
+        cells = set()
+        for x, y in positions:
+            for dy in (-1, 0, 1):
+                for dx in (-1, 0, 1):
+                    cx, cy = x + dx, y + dy
+                    if(cx >= 0 and cx < self.tiles_w
+                    and cy >= 0 and cy < self.tiles_h):
+                        cells.add((cx, cy))
+
+        for cell in cells:
+            self.bake_tile(cell)
+
+        self.force = True
+        self.redraw = True
 
 
 class World (MovingObject):
@@ -1307,155 +2590,222 @@ class Input (Object):
 #------------------------------------------------------------------------------
 
 class Builder:
+    # types of the objects whose children and images are built
+    # only when they are used, see Image.activate
+    LAZY_TYPES = ("Zone",)
+
     def __init__(self, package):
         self.package = package
 
-        # extract package
-        # TODO
+        # compiled package, if it is up to date
+        self.bundle = get_bundle(package + "/main.fxpq")
+
+        # objects of the parsed files, by id
+        self.files = {}
+
+        # objects already built, by (file, id),
+        # and the number of objects they are a child of
+        self.objects = {}
+        self.owners = {}
+
+        # objects being built, to detect reference cycles
+        self.building = []
+
+        # decode all the images of the package at once
+        global ASSETS
+        ASSETS.preload(self.get_images(package + "/main.fxpq"))
 
         # create objects recursively
         self.root = next(self.create_from_file(package + "/main.fxpq",
                                                type="Dimension", unique=True))
 
-    def create_from_file(self, file, type="", unique=False):
-        # parse file
+    def parse(self, file):
+        """ Return the objects of a file by id, parsing the file only once """
         try:
-            tree = ET.parse(file)
-        except Exception, e:
-            raise e
+            return self.files[file]
+        except KeyError:
+            pass
+
+        objects = None
+        if self.bundle:
+            objects = self.bundle.get_objects(file)
+
+        if objects is None:
+            objects = parse_fxpq(file)
 
-        # get active directory
-        directory = file[:file.rfind("/")]
+        self.files[file] = objects
+        return objects
 
-        # get root element
-        fxpq = tree.getroot()
+    # NOTE : recursive
+    def get_images(self, file, found=None, lazy=False):
+        """ Return the image files used by the objects of a file
+            and the objects they reference, except the content
+            of lazy objects unless "lazy" is True.
+        """
+        if found is None:
+            found = set()
 
-        # get version
-        # TODO : if specs become to change in the future,
-        #        manage versions to fit retro-compatibility
-        version = fxpq.get("version")
+        if file in found:
+            return []
+        found.add(file)
 
-        # create a temp list of read objects
-        templist = {}
+        images = []
+        for obj in self.parse(file).values():
+            if obj["type"] in self.LAZY_TYPES and not lazy:
+                continue
 
-        # flag to know if an object has been found
-        found = False
+            images += self.get_record_images(obj, found)
 
-        # for each object found
-        for i, obj in enumerate(fxpq.findall("object")):
-            # get name
-            id = obj.get("id")
+        return images
+
+    # NOTE : recursive
+    def get_record_images(self, obj, found):
+        """ Return the image files used by an object and its children """
+        images = []
+        for p in obj["properties"]:
+            if p[0] == "image" and p[1]:
+                images.append(self.package + p[1])
+
+        for child, cid in obj["children"]:
+            try:
+                images += self.get_images(child, found)
+            except IOError:  # missing files fail when they are built
+                pass
 
-            # get type
-            t = obj.get("type")
+        return images
 
-            # check type
-            if type:
-                # pass incorrect type
-                if t != type:
-                    continue
+    def create_from_file(self, file, type="", unique=False):
+        # for each object found
+        for id, obj in self.parse(file).items():
+            # pass incorrect type
+            if type and obj["type"] != type:
+                continue
+
+            # return object
+            yield self.create(file, id)
 
             # pass other objects if we wanted only one
             if unique:
-                if found:
-                    break
+                break
 
-            # we passed the type check, so we found an object
-            found = True
+    def create(self, file, id):
+        """ Return the object "id" of a file, built only once """
+        key = (file, id)
+        try:
+            instance = self.objects[key]
+        except KeyError:
+            pass
+        else:
+            self.owners[key] += 1
+            return instance
 
-            # create instance
-            try:
-                instance = globals()[t](id)
-            except Exception, e:
-                raise e
-
-            # register object
-            templist[id] = instance
-
-            # parse properties
-            properties = obj.find("properties")
-            if properties is not None:
-                for p in properties:
-                    if p.tag == "rect":
-                        # rect property
-                        try:
-                            x = int(p.attrib["x"])
-                            y = int(p.attrib["y"])
-                            w = int(p.attrib["w"])
-                            h = int(p.attrib["h"])
-                        except ValueError, e:
-                            raise e
-                        else:
-                            instance.set_rect((x, y, w, h))
+        # the object is a child of itself
+        if key in self.building:
+            cycle = self.building[self.building.index(key):] + [key]
+            raise Exception("Reference cycle: {}".format(
+                            " -> ".join("{}#{}".format(f, i)
+                                        for f, i in cycle)))
 
-                        # priority (optional)
-                        try:
-                            z = int(p.attrib["z"])
-                        except KeyError, ValueError:
-                            pass
-                        else:
-                            instance.z = z
-
-                    elif p.tag == "image":
-                        # image loading
-                        if p.attrib["src"]:
-                            instance.load_from_file(self.package +
-                                                    p.attrib["src"])
-                        if p.attrib["autoresize"] == "true":
-                            #instance.set_size() TODO
-                            pass
-                    else:
-                        raise Exception("The property \"{}\" cannot be set"
-                                        "for an object of type \"Fxp.{}\""
-                                        .format(p.tag,
-                                                self.__class__.__name__))
-
-            # parse nodes
-            for node in obj.findall("node"):
-                # create a new node
-                new_node = {}
-
-                # find keys
-                for key in node.findall("key"):
-                    key_id = key.get("id")
-                    key_type = key.get("type")
-                    new_node[key_id] = (key_type, key.text)
-
-                # add the node to the instance
-                node_id = node.get("id")
-                instance.data[node_id] = new_node
-
-            # parse scripts
-            for script in obj.findall("script"):
-                if script.get("name") and script.get("exec") and script.text:
-                    instance.scripts[script.get("name")] = (script.get("exec"),
-                                                            file,
-                                                            script.text.strip()
-                                                            )
-
-            # parse children
-            for child in obj.findall("child"):
-                path = child.get("id")
-                if path.find("/") >= 0:
-                    cid = path[path.find("/") + 1:]
-                else:
-                    cid = path
+        self.building.append(key)
+        try:
+            instance = self.build(self.parse(file)[id])
+        finally:
+            self.building.pop()
 
-                # check for childs inside the current file
-                if cid in templist.keys():
-                    instance.add_child(templist[path])
-                else:
-                    # check inside child's file
-                    children = self.create_from_file("{}/{}.fxpq"
-                                                     .format(directory, path))
+        self.objects[key] = instance
+        self.owners[key] = 1
+        return instance
 
-                    # find object with corresponding id
-                    for c in children:
-                        if cid == c.name:
-                            instance.add_child(c)
+    def build(self, obj):
+        """ Create an object from the dict returned by parse_fxpq,
+            lazy objects get only their rect and nodes until they are used.
+        """
+        # create instance
+        try:
+            instance = globals()[obj["type"]](obj["id"])
+        except Exception, e:
+            raise e
 
-            # return object
-            yield instance
+        # set properties
+        for p in obj["properties"]:
+            if p[0] == "rect":
+                tag, rect, z = p
+                instance.set_rect(rect)
+
+                # priority (optional)
+                if z is not None:
+                    instance.z = z
+
+        # add nodes
+        for node_id, node in obj["nodes"]:
+            instance.data[node_id] = dict(node)
+
+        if obj["type"] in self.LAZY_TYPES:
+            instance.loader = (self, obj)
+            instance.loaded = False
+        else:
+            self.fill(instance, obj)
+
+        return instance
+
+    def fill(self, instance, obj):
+        """ Load the images, scripts and children of an object """
+        for step in self.fill_steps(instance, obj, wait=True):
+            pass
+
+    def fill_steps(self, instance, obj, wait=False):
+        """ Same as fill, step by step: None is yielded while the images
+            are decoded, unless "wait" is True, and after each child built.
+        """
+        # decode the images of a lazy object together, beforehand
+        if instance.loader:
+            global ASSETS
+            for step in ASSETS.preload_steps(self.get_record_images(obj,
+                                                                    set()),
+                                             wait=wait):
+                yield None
+
+        # set properties
+        for p in obj["properties"]:
+            if p[0] == "image":
+                # image loading
+                tag, src, autoresize = p
+                if src:
+                    instance.load_from_file(self.package + src)
+                if autoresize:
+                    #instance.set_size() TODO
+                    pass
+
+        # add scripts
+        for name, script in obj["scripts"]:
+            instance.scripts[name] = script
+
+        # add children
+        for file, cid in obj["children"]:
+            if cid in self.parse(file):
+                instance.add_child(self.create(file, cid))
+                yield None
+
+    def forget(self, instance):
+        """ Forget and release the objects built for the children
+            of a lazy object, so that they are built again when it is
+            activated. The ones still used by other objects are kept.
+        """
+        keys = dict((id(obj), key) for key, obj in self.objects.items())
+        found = instance.objects.values()
+        while found:
+            obj = found.pop()
+            key = keys.get(id(obj))
+            if key is not None:
+                self.owners[key] -= 1
+                if self.owners[key] > 0:
+                    continue
+
+                del self.objects[key]
+                del self.owners[key]
+
+            obj.release()
+            found += obj.objects.values()
 
 
 class Dimension(Image):
@@ -1464,9 +2814,49 @@ class Dimension(Image):
 
 
 class Zone(Image):
+    """ Part of a dimension, built only when it is used.
+
+        The zones next to it are listed by its "neighbours" node,
+        or reached through the portals it contains.
+    """
     def __init__(self, name):
         Image.__init__(self, name)
 
+    def get_portals(self):
+        return [obj for obj in self.objects.values()
+                if isinstance(obj, Portal)]
+
+    def get_neighbours(self):
+        """ Return the names of the zones next to this one """
+        names = [value for type, value
+                 in self.data.get("neighbours", {}).values()]
+
+        for portal in self.get_portals():
+            names.append(portal.get_zone())
+
+        # keep the first occurrence of each name
+        return [name for i, name in enumerate(names)
+                if not name in names[:i]]
+
+
+class Portal(MovingObject):
+    """ Passage to another zone, described by the "portal" node:
+        the name of the zone and the position of arrival in it.
+    """
+    def __init__(self, name):
+        MovingObject.__init__(self, name)
+
+    def get_zone(self):
+        type, value = self.data["portal"]["zone"]
+        return value
+
+    def get_arrival(self):
+        portal = self.data["portal"]
+        if not "x" in portal or not "y" in portal:
+            return None
+
+        return (int(portal["x"][1]), int(portal["y"][1]))
+
 
 #------------------------------------------------------------------------------
 # USER INTERFACE
@@ -1482,36 +2872,24 @@ class Window(Image):
         # create signals
         self.add_signal("close")
 
+    def release(self):
+        if self.tileset:
+            self.tileset.release()
+            self.tileset = None
+
+        Image.release(self)
+
     def load(self):
         # open the tileset
         if not self.tileset:
             self.tileset = Tileset("window", "packages/window.png", 8)
 
-        # create the surface
-        self.image = Surface(self.get_size())
-
-        # display corners
-        w = self.w
-        h = self.h
-        g = self.grid_size
-        self.image.blit(self.tileset.get_tile((0, 0)), (0, 0))
-        self.image.blit(self.tileset.get_tile((2, 0)), (w - g, 0))
-        self.image.blit(self.tileset.get_tile((0, 2)), (0, h - g))
-        self.image.blit(self.tileset.get_tile((2, 2)), (w - g, h - g))
-
-        # display borders
-        for i in range(1, (self.w / g) - 1):
-            self.image.blit(self.tileset.get_tile((1, 0)), (i * g, 0))
-            self.image.blit(self.tileset.get_tile((1, 2)), (i * g, h - g))
-
-        for j in range(1, (self.h / g) - 1):
-            self.image.blit(self.tileset.get_tile((0, 1)), (0, j * g))
-            self.image.blit(self.tileset.get_tile((2, 1)), (w - g, j * g))
-
-        # body
+        # the frame is shared by the windows of the same size
         global PALETTE
-        self.image.fill(PALETTE.get_rgb("Black", "light"),
-                        (g, g, w - g * 2, h - g * 2))
+        filename, transforms = self.tileset.asset
+        body = PALETTE.get_rgb("Black", "light")
+        self.load_asset(filename, (("nine-slice", self.tileset.size,
+                                    self.grid_size, self.get_size(), body),))
 
     def open(self):
         if not self.display:
@@ -1546,41 +2924,31 @@ class Label (Image):
         # ...
 
     def set_text(self, text):
+        # nothing to do if the text did not change
+        if text == self.text and self.image is not None:
+            return
+
         self.text = text
         self.force = True
         self.load()
 
     def set_color(self, color, bg_color):
-        if color is not None:
-            self.color = color
+        color = color if color is not None else self.color
+        bg_color = bg_color if bg_color is not None else self.bg_color
 
-        if bg_color is not None:
-            self.bg_color = bg_color
+        # nothing to do if the colors did not change
+        if (color, bg_color) == (self.color, self.bg_color):
+            return
+
+        self.color = color
+        self.bg_color = bg_color
 
         self.load()
 
     def load(self):
         # create text
-        global PALETTE
         global FONT
-        self.image = FONT.write_line(self.text)
-
-        # change colors
-        default_color = PALETTE.get_rgb("White", "light")
-        default_bg_color = PALETTE.get_rgb("Black", "medium")
-
-        if (self.color == default_bg_color
-        and self.bg_color == default_color):
-            # swap front and bg
-            self.image.replace_color(default_color,
-                                     default_bg_color, swap=True)
-        elif (self.color == default_color
-        and self.bg_color == default_bg_color):
-            # don't swap anything
-            pass
-        else:
-            self.image.replace_color(default_color, self.color)
-            self.image.replace_color(default_bg_color, self.bg_color)
+        self.image = FONT.render(self.text, self.color, self.bg_color)
 
         # set object size
         self.set_size(self.image.get_size())
@@ -1600,6 +2968,9 @@ class Button (Image):
         self.color = color_name
         self.sensitive = True
 
+        # images of the states already rendered
+        self.images = {}
+
         # create signals
         self.add_signal("click")
 
@@ -1648,9 +3019,6 @@ class Button (Image):
         h = self.grid_size
         self.set_size((w + 2, h + 2))
 
-        # prepare surface
-        # the surface is one pixel larger for every border
-        self.image = Surface((w + 2, h + 2))
         # this is the real position of the button on the surface
         x = 1
         y = 1
@@ -1658,24 +3026,36 @@ class Button (Image):
         self.x_offset = -1
         self.y_offset = -1
 
-        # render body
-        self.image.fill(body, [x, y, w, h])
-        pygame.draw.line(self.image, border_top,
-                         (x, y - 1), (x + w - 1, y - 1))
-        pygame.draw.line(self.image, border_top,
-                         (x - 1, y), (x - 1, y + h - 1))
-        pygame.draw.line(self.image, border_bottom,
-                         (x, y + h), (x + w - 1, y + h))
-        pygame.draw.line(self.image, border_bottom,
-                         (x + w, y), (x + w, y + h - 1))
+        # render each state once
+        key = (self.state, self.text, self.color, self.grid_size)
+        try:
+            self.image = self.images[key]
+        except KeyError:
+            # prepare surface
+            # the surface is one pixel larger for every border
+            self.image = Surface((w + 2, h + 2))
+
+            # render body
+            self.image.fill(body, [x, y, w, h])
+            pygame.draw.line(self.image, border_top,
+                             (x, y - 1), (x + w - 1, y - 1))
+            pygame.draw.line(self.image, border_top,
+                             (x - 1, y), (x - 1, y + h - 1))
+            pygame.draw.line(self.image, border_bottom,
+                             (x, y + h), (x + w - 1, y + h))
+            pygame.draw.line(self.image, border_bottom,
+                             (x + w, y), (x + w, y + h - 1))
+
+            self.images[key] = self.image
 
         # render text
         label_name = "button_label"
-        label = Label(label_name, self.text, text_color, text_bg_color)
-        label.set_pos((x, y))
-        if label_name in self.objects:
-            self.objects[label_name] = label
+        label = self.get_child(label_name)
+        if label:
+            label.set_text(self.text)
+            label.set_color(text_color, text_bg_color)
         else:
+            label = Label(label_name, self.text, text_color, text_bg_color)
             self.add_child(label)
 
         # move the text one pixel to the right if clicked
@@ -1699,6 +3079,17 @@ class Separator (Image):
             self.load()
 
     def load(self):
+        # the separators of the same size share their image
+        global ASSETS
+        key = ("separator", self.get_size())
+        image = ASSETS.get(key, self.create_image)
+
+        self.release_asset()
+        self.asset = key
+        self.image = image
+        self.surface = None
+
+    def create_image(self):
         # set colors
         global PALETTE
         border_top = PALETTE.get_rgb("Black", "medium")
@@ -1711,55 +3102,314 @@ class Separator (Image):
         h = self.h
 
         # render
-        self.image = Surface((w, h))
-        self.image.fill(0)
-        pygame.draw.line(self.image, border_top,
+        image = Surface((w, h))
+        image.fill(0)
+        pygame.draw.line(image, border_top,
                          (x, y), (x + w - 4, y))
-        pygame.draw.line(self.image, border_bottom,
+        pygame.draw.line(image, border_bottom,
                          (x + 1, y + 1), (x + w - 3, y + 1))
 
+        return image, get_surface_size(image)
+
 
 #------------------------------------------------------------------------------
 # PIXEL MANAGEMENT
 #------------------------------------------------------------------------------
 
+class Assets:
+    """ Cache of the images, tiles and fonts loaded from files.
+
+        Assets are shared by every object using them, so they must never
+        be modified in place. A transformed image (mirrored, duplicated,
+        recolored...) is another asset, keyed by the file and the list
+        of transforms applied to it.
+
+        Each asset counts the objects using it. When the cache grows
+        over its memory budget, the least recently used assets that are
+        not used anymore are dropped.
+    """
+    def __init__(self, budget=67108864):  # 64 MiB
+        self.entries = collections.OrderedDict()  # key -> [asset, size, refs]
+        self.budget = budget
+        self.memory = 0
+
+        # images decoded by preload, not made into surfaces yet,
+        # and the pools of threads decoding them, by number of threads,
+        # kept for the next preloads
+        self.decoded = {}
+        self.pools = {}
+
+        # statistics
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key, create):
+        """ Return the asset stored for "key" and count one more user.
+            On a miss, "create" is called to get the asset and its size.
+        """
+        try:
+            entry = self.entries.pop(key)
+            self.hits += 1
+        except KeyError:
+            asset, size = create()
+            entry = [asset, size, 0]
+            self.memory += size
+            self.misses += 1
+
+        # the most recently used assets are at the end
+        entry[2] += 1
+        self.entries[key] = entry
+
+        self.evict()
+        return entry[0]
+
+    def release(self, key):
+        """ Count one less user of an asset """
+        try:
+            entry = self.entries[key]
+        except KeyError:
+            return
+
+        if entry[2] > 0:
+            entry[2] -= 1
+
+        self.evict()
+
+    def evict(self):
+        """ Drop unused assets until the memory budget is respected """
+        if self.memory <= self.budget:
+            return
+
+        for key, entry in self.entries.items():
+            if self.memory <= self.budget:
+                break
+
+            if not entry[2]:
+                del self.entries[key]
+                self.memory -= entry[1]
+                self.evictions += 1
+
+    def clear(self):
+        """ Drop every asset, used or not """
+        self.entries.clear()
+        self.memory = 0
+
+    def get_stats(self):
+        return {"hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "assets": len(self.entries),
+                "memory": self.memory}
+
+    def load_image(self, filename, transforms=()):
+        """ Return the image of a file with the transforms applied """
+        def create():
+            if transforms:
+                # transform the image with one transform less
+                base = self.load_image(filename, transforms[:-1])
+                self.release((filename, transforms[:-1]))
+                image = transform_surface(base, transforms[-1])
+            else:
+                # compiled packages have their images decoded already
+                image = None
+                bundle = get_bundle(filename)
+                if bundle:
+                    image = bundle.get_image(filename)
+
+                if image is None:
+                    image = self.decoded.pop(filename, None)
+
+                if image is None:
+                    image = decode_image(filename)
+
+            # blit the image in the display format once, not every frame
+            image = normalize_surface(image, lossless=bool(transforms))
+            if not is_display_format(image):
+                print(":: Fxp Warning: \"{}\" {} is blitted with a format "
+                      "conversion.".format(filename, transforms))
+
+            return image, get_surface_size(image)
+
+        return self.get((filename, transforms), create)
+
+    def preload(self, filenames, threads=None):
+        """ Decode the images of files at once in a pool of threads,
+            one per processor by default. The surfaces are then created
+            on this thread, and kept in the cache until they are used. """
+        for step in self.preload_steps(filenames, threads, wait=True):
+            pass
+
+    def preload_steps(self, filenames, threads=None, wait=False):
+        """ Same as preload, step by step: None is yielded while the pool
+            decodes the images, unless "wait" is True, then after each
+            surface created. """
+        todo = []
+        ready = []
+        for filename in set(filenames):
+            if (filename, ()) in self.entries:
+                ready.append(filename)
+                continue
+
+            # compiled images are not decoded
+            bundle = get_bundle(filename)
+            if bundle and bundle.has_image(filename):
+                ready.append(filename)
+                continue
+
+            todo.append(filename)
+
+        if todo:
+            if threads is None:
+                threads = multiprocessing.cpu_count()
+
+            # the preloads running at once share the pool
+            if not threads in self.pools:
+                self.pools[threads] = multiprocessing.pool.ThreadPool(threads)
+
+            result = self.pools[threads].map_async(try_decode_image, todo)
+            while not wait and not result.ready():
+                yield None
+            images = result.get()
+
+            # files that cannot be decoded fail again when they are used
+            for filename, image in zip(todo, images):
+                if image is not None:
+                    self.decoded[filename] = image
+                    ready.append(filename)
+
+        for filename in ready:
+            self.load_image(filename)
+            self.release((filename, ()))
+            yield None
+
+    def load_tiles(self, filename, size):
+        """ Return the image of a file cut in square tiles of "size" """
+        def create():
+            image = self.load_image(filename)
+            self.release((filename, ()))
+
+            w = image.get_width() / size
+            h = image.get_height() / size
+            tiles = []
+            for j in range(0, h):
+                for i in range(0, w):
+                    temp = Surface((size, size))
+                    temp.blit(image, (0, 0), (i * size, j * size, size, size))
+                    tiles.append(temp)
+
+            return (image, w, h, tiles), size * size * len(tiles)
+
+        return self.get((filename, (("tiles", size),)), create)
+
+    def load_chars(self, filename, size):
+        """ Return the ASCII chars of a font file """
+        def create():
+            image = self.load_image(filename)
+            self.release((filename, ()))
+
+            chars = {}
+            rect_x = 0
+            rect_y = 0
+            for i in range(0x20, 0x7F, 0x01):  # ASCII
+                if (i - 0x20) % 16 == 0 and i - 0x20 > 0:
+                    rect_y += size
+                    rect_x = 0
+
+                temp = Surface((size, size))
+                temp.blit(image, (0, 0), (rect_x, rect_y, size, size))
+                chars[chr(i)] = temp
+
+                rect_x += size
+
+            return chars, size * size * len(chars)
+
+        return self.get((filename, (("font", size),)), create)
+
+ASSETS = Assets()
+
+
 class Tileset:
     def __init__(self, name, filename, size):
         self.name = name
-        self.tiles = []
         self.rules = {}
         self.size = size
-        self.image = pygame.image.load(filename)
         self.solid = False
 
-        # parse image
-        self.w = self.image.get_width() / size
-        self.h = self.image.get_height() / size
-        for j in range(0, self.h):
-            for i in range(0, self.w):
-                temp = Surface((size, size))
-                temp.blit(self.image, (0, 0), (i * size, j * size, size, size))
-                self.tiles.append(temp)
+        # caches
+        self.atlas = None
+        self.rule_table = None
+
+        # the tiles are shared by the tilesets of the same file
+        self.image, self.w, self.h, self.tiles = \
+            ASSETS.load_tiles(filename, size)
+        self.asset = (filename, (("tiles", size),))
+
+    def release(self):
+        """ Stop using the shared tiles, so that they can be evicted """
+        global ASSETS
+        if self.asset:
+            ASSETS.release(self.asset)
+            self.asset = None
 
     def add_rule(self, name, tile, flag, mask=0xFF):
         self.rules[name] = (tile, flag, mask)
+        self.rule_table = None
 
-    def get_tile(self, pos):
+    def get_tile(self, pos, variant=None):
         if isinstance(pos, list):
-            pos = random.choice(pos)
+            if variant is None:
+                pos = random.choice(pos)
+            else:
+                pos = pos[variant % len(pos)]
         x, y = pos
         index = y * self.w + x
 
         return self.tiles[index]
 
-    def get_tile_by_rule(self, flag):
-        for rule in self.rules.values():
-            tile, rule_flag, rule_mask = rule
-            if rule_flag & rule_mask == flag & rule_mask:
-                return self.get_tile(tile)
+    def get_tile_by_rule(self, flag, variant=None):
+        candidates = self.get_rule_table()[flag]
+        if variant is None:
+            index = random.choice(candidates)
+        else:
+            index = candidates[variant % len(candidates)]
+
+        return self.tiles[index]
+
+    def get_rule_table(self):
+        """ Return the indices of the tiles matching each of the 256 flags """
+        if self.rule_table is None:
+            self.rule_table = []
+            for flag in range(0, 256):
+                # if nothing matches
+                tile = (0, 0)
+
+                for rule in self.rules.values():
+                    rule_tile, rule_flag, rule_mask = rule
+                    if rule_flag & rule_mask == flag & rule_mask:
+                        tile = rule_tile
+                        break
+
+                positions = tile if isinstance(tile, list) else [tile]
+                self.rule_table.append([y * self.w + x for x, y in positions])
+
+        return self.rule_table
 
-        # if nothing returned yet
-        return self.get_tile((0, 0))
+    def get_atlas(self):
+        """ Return the pixels of all the tiles in a single array,
+            indexed by tile, then x and y.
+        """
+        if self.atlas is None:
+            s = self.size
+            temp = Surface((self.w * s, self.h * s))
+            temp.blit(self.image, (0, 0))
+
+            pixels = pygame.surfarray.array2d(temp)
+            pixels = pixels.reshape(self.w, s, self.h, s)
+            self.atlas = pixels.transpose(2, 0, 1, 3)\
+                               .reshape(self.w * self.h, s, s)
+
+        return self.atlas
 
 
 class Color:
@@ -1782,22 +3432,38 @@ class Palette:
         self.colorkey = (0, 0, 0)
         self.default = None
 
+        # the arrays are computed again when the version changes
+        self.version = 0
+        self.array_version = None
+
+        # (name, tone) and rgb of each index, the colorkey comes first
+        self.entries = []
+        self.array = []
+        self.indices = {}
+
+        # arrays of the surfaces with recolors or another palette layout
+        self.variants = {}
+
     def append(self, color):
         if not color.name in self.colors.keys():
             self.colors[color.name] = color
+            self.version += 1
 
     def change_tone(self, name, tone, rgb):
         if name in self.colors.keys():
             self.colors[name].set_rgb(tone, rgb)
+            self.version += 1
 
     def set_colorkey(self, rgb):
         self.colorkey = rgb
+        self.version += 1
 
     def get_colorkey(self):
         return self.colorkey
 
     def set_default(self, colorname):
         self.default = colorname
+        self.version += 1
 
     def get_rgb(self, name, tone):
         if name in self.colors.keys():
@@ -1808,37 +3474,117 @@ class Palette:
             else:
                 return self.colorkey
 
-    def get_all_rgb(self):
-        result = [self.colorkey]
+    def update(self):
+        """ Compute the arrays again if the palette changed
+            since the last call """
+        if self.array_version == self.version:
+            return
+
+        self.entries = [None]
+        self.array = [self.colorkey]
         for color in self.colors.values():
             for tone in color.values.keys():
-                result.append(color.get_rgb(tone))
+                self.entries.append((color.name, tone))
+                self.array.append(color.get_rgb(tone))
+
+        self.indices = dict((entry, i) for i, entry in enumerate(self.entries))
+        self.variants = {}
+        self.array_version = self.version
+
+    def get_all_rgb(self):
+        return self.get_variant(self)[0]
+
+    def get_index(self, name, tone):
+        """ Return the index of a color in the palette array, or None """
+        self.update()
+        return self.indices.get((name, tone))
+
+    def get_variant(self, layout, recolors=()):
+        """ Return the array of a surface and a dict of its rgb indices
+            "layout" is the palette the surface was created with,
+            its colors are mapped by name and tone on this palette
+            "recolors" are the (old index, new index, new rgb, swap)
+            replacements done on the surface """
+        self.update()
+        layout.update()
+
+        key = (layout, layout.version, recolors)
+        try:
+            return self.variants[key]
+        except KeyError:
+            pass
+
+        if recolors:
+            array = list(self.get_variant(layout, recolors[:-1])[0])
+            oi, ni, new_rgb, swap = recolors[-1]
+            old_rgb = array[oi]
+            if ni is not None:
+                new_rgb = array[ni]
+
+            array[oi] = new_rgb
+            if swap:
+                array[ni] = old_rgb
+        elif layout is self:
+            array = list(self.array)
+        else:
+            array = [self.colorkey]
+            for name, tone in layout.entries[1:]:
+                # missing tones fall back on the default color
+                rgb = self.get_rgb(name, tone)
+                if rgb is None and self.default:
+                    rgb = self.colors[self.default].get_rgb(tone)
+                array.append(rgb or self.colorkey)
+
+        # the unused colors are the same on all the surfaces
+        if len(array) < 256:
+            array += [self.colorkey] * (256 - len(array))
+
+        indices = {}
+        for i, rgb in enumerate(array):
+            indices.setdefault(tuple(rgb), i)
+
+        self.variants[key] = (array, indices)
+        return self.variants[key]
+
 
-        return result
+def set_display(surface):
+    """ Use the format of "surface" for the surfaces created from now on
+        without a display, surfaces are 8 bits with the global palette """
+    global DISPLAY, LAYOUT, PALETTE
+    DISPLAY = surface
+    LAYOUT = PALETTE
+
+
+def use_palette(palette):
+    """ Set the global palette and recolor all the surfaces in one pass
+        the pixels are kept, the colors are mapped by name and tone """
+    global PALETTE
+    PALETTE = palette
+
+    for surface in list(SURFACES):
+        surface.update_palette()
+        surface.set_colorkey(palette.get_colorkey())
 
 
 class Font:
     def __init__(self, filename, size):
-        self.chars = {}
         self.filename = filename
         self.size = size
 
-        # open image file
-        image = pygame.image.load(filename)
-
-        # parse file
-        rect_x = 0
-        rect_y = 0
-        for i in range(0x20, 0x7F, 0x01):  # ASCII
-            if (i - 0x20) % 16 == 0 and i - 0x20 > 0:
-                rect_y += size
-                rect_x = 0
+        # the chars are shared by the fonts of the same file
+        self.chars = ASSETS.load_chars(filename, size)
+        self.asset = (filename, (("font", size),))
 
-            temp = Surface((size, size))
-            temp.blit(image, (0, 0), (rect_x, rect_y, size, size))
-            self.chars[chr(i)] = temp
+        # lines already rendered, least recently used first
+        self.lines = collections.OrderedDict()  # (text, fg, bg) -> surface
+        self.lines_size = 256
 
-            rect_x += size
+    def release(self):
+        """ Stop using the shared chars, so that they can be evicted """
+        global ASSETS
+        if self.asset:
+            ASSETS.release(self.asset)
+            self.asset = None
 
     def write_line(self, text):
         # create a big enough surface
@@ -1848,42 +3594,117 @@ class Font:
         surface = Surface((w, h))
 
         # paste the chars
-        x = 0
-        for c in text:
-            surface.blit(self.chars[c], (x, 0))
-            x += self.size
+        blit_all(surface, [(self.chars[c], (i * self.size, 0), None)
+                           for i, c in enumerate(text)])
 
         # return the surface
         return surface
 
+    def render(self, text, color, bg_color):
+        """ Return a line of text in the given colors.
+            The surface is shared by every caller, it must not be modified.
+        """
+        key = (text, tuple(color), tuple(bg_color))
+        try:
+            surface = self.lines.pop(key)
+        except KeyError:
+            surface = self.write_line(text)
+
+            # change colors
+            global PALETTE
+            default_color = PALETTE.get_rgb("White", "light")
+            default_bg_color = PALETTE.get_rgb("Black", "medium")
+
+            if (color == default_bg_color
+            and bg_color == default_color):
+                # swap front and bg
+                surface.replace_color(default_color,
+                                      default_bg_color, swap=True)
+            elif (color == default_color
+            and bg_color == default_bg_color):
+                # don't swap anything
+                pass
+            else:
+                surface.replace_color(default_color, color)
+                surface.replace_color(default_bg_color, bg_color)
+
+            if surface.recolors:
+                surface = normalize_surface(surface)
+
+            # forget the least recently used line
+            if len(self.lines) >= self.lines_size:
+                self.lines.popitem(last=False)
+
+        # the most recently used lines are at the end
+        self.lines[key] = surface
+
+        return surface
+
 
 class Surface (pygame.Surface):
     def __init__(self, size):
-        pygame.Surface.__init__(self, size)
+        pygame.Surface.__init__(self, size, 0, 8)
+
+        # the palette the pixels are drawn with, and the colors replaced
+        global PALETTE, LAYOUT
+        self.layout = LAYOUT or PALETTE
+        self.recolors = ()
 
         # init
-        global PALETTE
-        self.set_palette(PALETTE.get_all_rgb())
+        self.set_palette(PALETTE.get_variant(self.layout)[0])
         self.set_colorkey(PALETTE.get_colorkey())
         self.fill(PALETTE.get_colorkey())
 
+        # subsurfaces of the frames blitted from the surface
+        self.slices = {}
+
+        SURFACES.add(self)
+
     def clear(self):
         global PALETTE
         self.fill(PALETTE.get_colorkey())
 
+    def get_slice(self, rect):
+        """ Return a subsurface of the surface, created once per rect """
+        try:
+            return self.slices[rect]
+        except KeyError:
+            self.slices[rect] = self.subsurface(rect)
+            return self.slices[rect]
+
+    def update_palette(self):
+        """ Set the array of the global palette with the recolors applied """
+        global PALETTE
+        self.set_palette(PALETTE.get_variant(self.layout, self.recolors)[0])
+
+        # subsurfaces keep the palette they were created with
+        self.slices = {}
+
+    def copy_palette(self, surface):
+        """ Use the palette layout and the recolors of another surface """
+        try:
+            self.layout = surface.layout
+            self.recolors = surface.recolors
+        except AttributeError:
+            self.set_palette(surface.get_palette())
+            return
+
+        self.update_palette()
+
     def replace_color(self, old_rgb, new_rgb, swap=False):
-        palette = [color for color in self.get_palette()]
+        global PALETTE
+        indices = PALETTE.get_variant(self.layout, self.recolors)[1]
         try:
-            oi = palette.index(old_rgb)
-            if swap:
-                ni = palette.index(new_rgb)
-        except ValueError:
+            oi = indices[tuple(old_rgb)]
+        except KeyError:
             return
 
-        palette[oi] = new_rgb
-        if swap:
-            palette[ni] = old_rgb
-        self.set_palette(palette)
+        ni = indices.get(tuple(new_rgb))
+        if swap and ni is None:
+            return
+
+        self.recolors += ((oi, ni, tuple(new_rgb), swap),)
+        self.update_palette()
 
 
 #------------------------------------------------------------------------------
@@ -1893,7 +3714,7 @@ class Surface (pygame.Surface):
 class BinaryString:
     def __init__(self, filename, max_size):
         # load raw binary data
-        f = open(filename, "rb")
+        f = open_file(filename)
 
         f.seek(0, 2)
         size = f.tell()
@@ -1908,6 +3729,566 @@ class BinaryString:
         self.array = bytearray(string)
 
 
+def parse_palette(file):
+    """ Return the (name, colorkey, default, colors) of a palette file,
+        "colors" being the (name, [(tone, rgb), ...]) of each color,
+        the elements are read one by one instead of building a tree """
+    name = None
+    colorkey = (0, 0, 0)
+    default = None
+    colors = []
+
+    for event, elem in ET.iterparse(file, events=("start", "end")):
+        if event == "start":
+            if elem.tag == "palette":
+                name = elem.get("name")
+            elif elem.tag == "color":
+                colors.append((elem.get("name"), []))
+
+        elif elem.tag == "value":
+            rgb = tuple(int(v) for v in elem.text.split(","))
+            colors[-1][1].append((elem.get("tone"), rgb))
+        elif elem.tag == "color":
+            elem.clear()
+        elif elem.tag == "colorkey":
+            colorkey = tuple(int(v) for v in elem.text.split(","))
+        elif elem.tag == "default":
+            default = elem.text
+
+    return (name, colorkey, default, colors)
+
+
+def make_palette(compiled):
+    """ Create a palette from the values returned by parse_palette """
+    name, colorkey, default, colors = compiled
+    palette = Palette(name)
+    palette.set_colorkey(colorkey)
+    palette.set_default(default)
+    for colorname, values in colors:
+        color = Color(colorname)
+        for tone, rgb in values:
+            color.set_rgb(tone, rgb)
+        palette.append(color)
+
+    return palette
+
+
+def load_palette(filename):
+    """ Return the palette of a file, parsed only once for each content
+        the file is only read again when its date or size changed """
+    global PALETTES, PALETTE_FILES
+    filename = os.path.normpath(filename)
+
+    # the files of an archive change with it
+    archive, name = get_archive(filename)
+    if archive:
+        stat = os.stat(archive.filename)
+    else:
+        stat = os.stat(filename)
+    date = (stat.st_mtime, stat.st_size)
+
+    cached = PALETTE_FILES.get(filename)
+    if cached and cached[0] == date and cached[1] in PALETTES:
+        return make_palette(PALETTES[cached[1]])
+
+    if archive:
+        f = archive.open(name)
+    else:
+        f = open(filename, "rb")
+    data = f.read()
+    f.close()
+
+    digest = hashlib.md5(data).hexdigest()
+    try:
+        compiled = PALETTES[digest]
+    except KeyError:
+        compiled = parse_palette(cStringIO.StringIO(data))
+        PALETTES[digest] = compiled
+
+    PALETTE_FILES[filename] = (date, digest)
+    return make_palette(compiled)
+
+
+def parse_fxpq(file):
+    """ Return the objects of a fxpq file by id,
+        as dicts of plain values that Builder.build turns into objects """
+    # parse file
+    f = open_file(file)
+    try:
+        tree = ET.parse(f)
+    except Exception, e:
+        raise e
+    finally:
+        f.close()
+
+    # get active directory
+    directory = file[:file.rfind("/")]
+
+    # get root element
+    fxpq = tree.getroot()
+
+    # get version
+    # TODO : if specs become to change in the future,
+    #        manage versions to fit retro-compatibility
+    version = fxpq.get("version")
+
+    ids = set([obj.get("id") for obj in fxpq.findall("object")])
+
+    objects = collections.OrderedDict()
+    for obj in fxpq.findall("object"):
+        # get name and type
+        id = obj.get("id")
+        t = obj.get("type")
+
+        # parse properties
+        properties = []
+        node = obj.find("properties")
+        if node is not None:
+            for p in node:
+                if p.tag == "rect":
+                    # rect property
+                    try:
+                        x = int(p.attrib["x"])
+                        y = int(p.attrib["y"])
+                        w = int(p.attrib["w"])
+                        h = int(p.attrib["h"])
+                    except ValueError, e:
+                        raise e
+
+                    # priority (optional)
+                    try:
+                        z = int(p.attrib["z"])
+                    except KeyError, ValueError:
+                        z = None
+
+                    properties.append(("rect", (x, y, w, h), z))
+
+                elif p.tag == "image":
+                    # image loading
+                    properties.append(("image", p.attrib["src"],
+                                       p.attrib["autoresize"] == "true"))
+                else:
+                    raise Exception("The property \"{}\" cannot be set"
+                                    "for an object of type \"Fxp.{}\""
+                                    .format(p.tag, t))
+
+        # parse nodes
+        nodes = []
+        for node in obj.findall("node"):
+            # create a new node
+            new_node = {}
+
+            # find keys
+            for key in node.findall("key"):
+                key_id = key.get("id")
+                key_type = key.get("type")
+                new_node[key_id] = (key_type, key.text)
+
+            nodes.append((node.get("id"), new_node))
+
+        # parse scripts
+        scripts = []
+        for script in obj.findall("script"):
+            if script.get("name") and script.get("exec") and script.text:
+                scripts.append((script.get("name"), (script.get("exec"),
+                                                     file,
+                                                     script.text.strip())))
+
+        # parse children
+        children = []
+        for child in obj.findall("child"):
+            path = child.get("id")
+            if path.find("/") >= 0:
+                cid = path[path.find("/") + 1:]
+            else:
+                cid = path
+
+            # check for childs inside the current file
+            if cid in ids:
+                children.append((file, cid))
+            else:
+                # the child is inside its own file
+                children.append(("{}/{}.fxpq".format(directory, path), cid))
+
+        objects[id] = {"id": id,
+                       "type": t,
+                       "properties": properties,
+                       "nodes": nodes,
+                       "scripts": scripts,
+                       "children": children}
+
+    return objects
+
+
+class Bundle:
+    """ Package compiled in a single file by write_bundle.
+
+        The bundle holds the objects of the fxpq files with their scripts
+        compiled, the palettes, and the pixels of the images in the
+        display format. It is mapped in memory, and each entry is only
+        read when it is used.
+
+        The sources are checked when the bundle is opened, the entries
+        of the files modified since are ignored and read from the sources.
+    """
+    magic = "FXPB"
+    version = 1
+
+    def __init__(self, filename):
+        self.filename = filename
+
+        f = open(filename, "rb")
+        try:
+            self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        finally:
+            f.close()
+
+        # check header and version
+        if(self.data[:4] != self.magic
+        or ord(self.data[4]) != self.version):
+            raise ValueError("\"{}\" is not a bundle of version {}"
+                             .format(filename, self.version))
+
+        # get the index at the end
+        offset, size = struct.unpack("<II", self.data[5:13])
+        self.index = marshal.loads(self.data[offset:offset + size])
+
+        self.stale = self.get_stale()
+
+    def get_stale(self):
+        """ Return the sources modified since the bundle was written """
+        stale = set()
+        for filename, (mtime, size, digest) in self.index["sources"].items():
+            try:
+                stat = os.stat(filename)
+            except OSError:
+                stale.add(filename)
+                continue
+
+            # the content is only read when the date changed
+            if stat.st_mtime == mtime and stat.st_size == size:
+                continue
+
+            if stat.st_size != size or get_digest(filename) != digest:
+                stale.add(filename)
+
+        return stale
+
+    def read(self, section, filename):
+        """ Return an entry of the bundle, or None if it is not up to date """
+        filename = os.path.normpath(filename)
+        if filename in self.stale:
+            return None
+
+        try:
+            offset, size = self.index[section][filename][:2]
+        except KeyError:
+            return None
+
+        return self.data[offset:offset + size]
+
+    def get_objects(self, filename):
+        """ Return the objects of a fxpq file, like parse_fxpq """
+        data = self.read("objects", filename)
+        if data is None:
+            return None
+
+        return collections.OrderedDict(marshal.loads(data))
+
+    def get_palette(self, filename):
+        data = self.read("palettes", filename)
+        if data is None:
+            return None
+
+        return make_palette(marshal.loads(data))
+
+    def has_image(self, filename):
+        """ Check if get_image returns the image of a file """
+        filename = os.path.normpath(filename)
+        return (filename in self.index["images"]
+                and not filename in self.stale
+                and self.index["colors"] == get_display_format()[2])
+
+    def get_image(self, filename):
+        """ Return the image of a file, if it was written in the format
+            of the display, so that it does not need any conversion """
+        if self.index["colors"] != get_display_format()[2]:
+            return None
+
+        data = self.read("images", filename)
+        if data is None:
+            return None
+
+        size = self.index["images"][os.path.normpath(filename)][2]
+        temp = pygame.image.fromstring(data, size, "P")
+        temp.set_palette(self.index["colors"])
+
+        # same palette, the pixels are copied as they are
+        image = Surface(size)
+        image.blit(temp, (0, 0))
+
+        return image
+
+
+def write_bundle(filename, sources, objects, palettes, images):
+    """ Write a bundle read by the Bundle class
+        "sources" are the files compiled, "objects" the results of
+        parse_fxpq by file, "palettes" and "images" the loaded palettes
+        and images in the display format by file """
+    # the bundle being replaced may still be mapped in memory
+    temp = filename + ".tmp"
+    f = open(temp, "wb")
+    f.write(Bundle.magic + chr(Bundle.version) + struct.pack("<II", 0, 0))
+
+    def write(data):
+        offset = f.tell()
+        f.write(data)
+        return (offset, len(data))
+
+    index = {"sources": {},
+             "objects": {},
+             "palettes": {},
+             "images": {},
+             "colors": get_display_format()[2]}
+
+    for source in sources:
+        stat = os.stat(source)
+        index["sources"][source] = (stat.st_mtime, stat.st_size,
+                                    get_digest(source))
+
+    for source, fxpq in objects.items():
+        # compile the scripts
+        compiled = []
+        for id, obj in fxpq.items():
+            scripts = [(name, (exec_type, file, compile(text, file, "exec")))
+                       for name, (exec_type, file, text) in obj["scripts"]]
+            compiled.append((id, dict(obj, scripts=scripts)))
+
+        index["objects"][source] = write(marshal.dumps(compiled))
+
+    for source, palette in palettes.items():
+        colors = [(color.name, color.values.items())
+                  for color in palette.colors.values()]
+        index["palettes"][source] = write(marshal.dumps((
+            palette.name, palette.colorkey, palette.default, colors)))
+
+    for source, image in images.items():
+        index["images"][source] = (write(pygame.image.tostring(image, "P"))
+                                   + (image.get_size(),))
+
+    offset, size = write(marshal.dumps(index))
+    f.seek(5)
+    f.write(struct.pack("<II", offset, size))
+    f.close()
+
+    try:
+        os.rename(temp, filename)
+    except OSError:  # the file exists on Windows
+        os.remove(filename)
+        os.rename(temp, filename)
+
+    # open the new bundle next time
+    global BUNDLES
+    BUNDLES.pop(filename[:-len(".fxpb")], None)
+
+
+class Archive:
+    """ Package shared as a single zip file, named like its directory
+        with the ".fxpk" extension.
+
+        The archive is opened once and mapped in memory, and its files
+        are found in the index of the zip file. Nothing is extracted
+        on disk: stored files are read from the memory map, and
+        compressed ones are inflated in memory.
+    """
+    def __init__(self, filename):
+        self.filename = filename
+
+        f = open(filename, "rb")
+        try:
+            self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        finally:
+            f.close()
+
+        # the memory map is the only handle on the file
+        self.zip = zipfile.ZipFile(MappedFile(self.data, 0, len(self.data)))
+        self.lock = threading.Lock()
+        self.entries = dict((os.path.normpath(info.filename), info)
+                            for info in self.zip.infolist()
+                            if not info.filename.endswith("/"))
+
+    def open(self, name):
+        """ Return a file object reading a file of the archive """
+        info = self.entries[os.path.normpath(name)]
+        if info.compress_type != zipfile.ZIP_STORED:
+            # the zip file has one position, shared by the threads
+            with self.lock:
+                data = self.zip.read(info)
+            return cStringIO.StringIO(data)
+
+        # the data follows the local header of the file
+        header = self.data[info.header_offset:info.header_offset + 30]
+        name_size, extra_size = struct.unpack("<HH", header[26:30])
+        start = info.header_offset + 30 + name_size + extra_size
+
+        return MappedFile(self.data, start, info.file_size)
+
+
+class MappedFile:
+    """ Read-only file object on a part of a memory map,
+        the reads return copies of the data as strings """
+    def __init__(self, data, start, size):
+        self.data = data
+        self.start = start
+        self.size = size
+        self.pos = 0
+
+    def read(self, size=-1):
+        if size < 0 or self.pos + size > self.size:
+            size = self.size - self.pos
+
+        start = self.start + self.pos
+        self.pos += size
+        return self.data[start:start + size]
+
+    def seek(self, offset, whence=0):
+        if whence == 1:
+            offset += self.pos
+        elif whence == 2:
+            offset += self.size
+
+        self.pos = min(max(offset, 0), self.size)
+
+    def tell(self):
+        return self.pos
+
+    def close(self):
+        pass
+
+
+def get_packs(filename, extension, packs, cls):
+    """ Return the (directory, pack) of the directories containing a file,
+        the innermost first, where "directory" + "extension" is a file
+        opened with "cls" and kept in the "packs" dict by directory """
+    result = []
+    directory = os.path.dirname(os.path.normpath(filename))
+
+    # stop at the root of absolute paths, which is its own parent
+    while directory and directory != os.path.dirname(directory):
+        try:
+            pack = packs[directory]
+        except KeyError:
+            pack = None
+            if os.path.isfile(directory + extension):
+                try:
+                    pack = cls(directory + extension)
+                except (IOError, ValueError, EOFError,
+                        zipfile.BadZipfile), e:
+                    print(":: Fxp Warning: {}".format(e))
+
+            packs[directory] = pack
+
+        if pack:
+            result.append((directory, pack))
+
+        directory = os.path.dirname(directory)
+
+    return result
+
+
+def get_bundle(filename):
+    """ Return the bundle compiled from the package of a file, or None """
+    global BUNDLES
+    for directory, bundle in get_packs(filename, ".fxpb", BUNDLES, Bundle):
+        return bundle
+
+    return None
+
+
+def get_archive(filename):
+    """ Return the archive holding a file and the name of the file in it,
+        or (None, None) if the file is not in an archive """
+    global ARCHIVES
+    filename = os.path.normpath(filename)
+    for directory, archive in get_packs(filename, ".fxpk", ARCHIVES,
+                                        Archive):
+        name = filename[len(directory) + 1:]
+        if name in archive.entries:
+            return archive, name
+
+    return None, None
+
+
+def open_file(filename):
+    """ Open a file to read it, from the archive of its package if any """
+    archive, name = get_archive(filename)
+    if archive:
+        return archive.open(name)
+
+    return open(filename, "rb")
+
+
+def list_files(directory):
+    """ Return the sorted names of the files of a directory, like open_file
+        finds them: on disk, in the archives and in the bundles of its
+        packages, so that a package shipped as a single file is listed too """
+    global ARCHIVES, BUNDLES
+    directory = os.path.normpath(directory)
+    names = set()
+
+    if os.path.isdir(directory):
+        names.update(name for name in os.listdir(directory)
+                     if os.path.isfile(os.path.join(directory, name)))
+
+    # the packs of a file in the directory are the ones of the directory
+    inside = os.path.join(directory, "*")
+    for parent, archive in get_packs(inside, ".fxpk", ARCHIVES, Archive):
+        for name in archive.entries:
+            filename = os.path.join(parent, name)
+            if os.path.dirname(filename) == directory:
+                names.add(os.path.basename(filename))
+
+    # the entries of the sources modified since are not read from bundles
+    for parent, bundle in get_packs(inside, ".fxpb", BUNDLES, Bundle):
+        for source in bundle.index["sources"]:
+            filename = os.path.normpath(source)
+            if(os.path.dirname(filename) == directory
+            and not filename in bundle.stale):
+                names.add(os.path.basename(filename))
+
+    return sorted(names)
+
+
+def decode_image(filename):
+    """ Return the image of a file as decoded by pygame
+        files on disk are decoded without holding the GIL,
+        so that threads decode several images at once """
+    archive, name = get_archive(filename)
+    if archive is None:
+        return pygame.image.load(filename)
+
+    f = archive.open(name)
+    image = pygame.image.load(f, filename)
+    f.close()
+
+    return image
+
+
+def try_decode_image(filename):
+    try:
+        return decode_image(filename)
+    except (pygame.error, IOError):
+        return None
+
+
+def get_digest(filename):
+    f = open(filename, "rb")
+    digest = hashlib.md5(f.read()).hexdigest()
+    f.close()
+
+    return digest
+
+
 #------------------------------------------------------------------------------
 # TOOLS
 #------------------------------------------------------------------------------
@@ -1918,6 +4299,238 @@ class Bunch:
         self.__dict__.update(kwds)
 
 
+def get_surface_size(surface):
+    """ Return the memory used by the pixels of a surface """
+    w, h = surface.get_size()
+    return w * h * surface.get_bytesize()
+
+
+def transform_surface(image, transform):
+    """ Return a transformed copy of an image.
+        "transform" is a tuple of the transform name and its arguments.
+    """
+    name = transform[0]
+    if name == "mirror":
+        return mirror_surface(image, *transform[1:])
+    elif name == "duplicate":
+        return duplicate_surface(image, *transform[1:])
+    elif name == "recolor":
+        return recolor_surface(image, *transform[1:])
+    elif name == "nine-slice":
+        return nine_slice_surface(image, *transform[1:])
+    else:
+        raise ValueError("Unknown transform \"{}\".".format(name))
+
+
+def mirror_surface(image, horizontal=True, rect=None):
+    """ Return the image followed by its mirrored version,
+        mirrored frame by frame if the frame size "rect" is given.
+    """
+    # get the corresponding dimensions
+    iw, ih = image.get_size()
+    if horizontal:
+        w = iw * 2
+        h = ih
+    else:
+        w = iw
+        h = ih * 2
+
+    # create a new surface
+    temp = Surface((w, h))
+    temp.copy_palette(image)
+
+    # blit the image on the new surface
+    temp.blit(image, (0, 0))
+
+    # check optional rect argument
+    if rect:
+        rw = rect[0]
+        rh = rect[1]
+        t = Surface((rw, rh))
+        t.copy_palette(image)
+    else:
+        rw = iw
+        rh = ih
+        t = image
+
+    # flip and blit image frame by frame
+    for y in range(0, ih, rh):
+        for x in range(0, iw, rw):
+            # extract frame
+            if t is not image:
+                t.clear()
+                t.blit(image, (0, 0), area=(x, y, rw, rh))
+
+            # blit flipped frame
+            if horizontal:
+                img = pygame.transform.flip(t, True, False)
+                temp.blit(img, (iw + x, y))
+            else:
+                img = pygame.transform.flip(t, False, True)
+                temp.blit(img, (x, ih + y))
+
+    return temp
+
+
+def duplicate_surface(image, horizontal=True):
+    """ Return the image repeated twice along an axis """
+    iw, ih = image.get_size()
+    if horizontal:
+        temp = Surface((iw * 2, ih))
+        temp.copy_palette(image)
+        temp.blit(image, (iw, 0))
+    else:
+        temp = Surface((iw, ih * 2))
+        temp.copy_palette(image)
+        temp.blit(image, (0, ih))
+
+    temp.blit(image, (0, 0))
+
+    return temp
+
+
+def recolor_surface(image, old_rgb, new_rgb, swap=False):
+    """ Return a copy of the image with a color replaced """
+    temp = Surface(image.get_size())
+    temp.copy_palette(image)
+    temp.blit(image, (0, 0))
+    temp.replace_color(old_rgb, new_rgb, swap)
+
+    return temp
+
+
+def nine_slice_surface(image, tile, grid, size, body):
+    """ Return a frame of the given size drawn with the 3x3 tiles
+        of the image: the corners, the borders repeated along the grid,
+        and a body filled with a solid color.
+    """
+    w, h = size
+    g = grid
+    temp = Surface(size)
+
+    def get_tile(i, j):
+        return (i * tile, j * tile, tile, tile)
+
+    # display corners
+    blits = [(image, (0, 0), get_tile(0, 0)),
+             (image, (w - g, 0), get_tile(2, 0)),
+             (image, (0, h - g), get_tile(0, 2)),
+             (image, (w - g, h - g), get_tile(2, 2))]
+
+    # display borders
+    for i in range(1, (w / g) - 1):
+        blits.append((image, (i * g, 0), get_tile(1, 0)))
+        blits.append((image, (i * g, h - g), get_tile(1, 2)))
+
+    for j in range(1, (h / g) - 1):
+        blits.append((image, (0, j * g), get_tile(0, 1)))
+        blits.append((image, (w - g, j * g), get_tile(2, 1)))
+
+    blit_all(temp, blits)
+
+    # body
+    temp.fill(body, (g, g, w - g * 2, h - g * 2))
+
+    return temp
+
+
+def get_display_format():
+    """ Return the format of the display, or of a new surface without it """
+    global DISPLAY
+    if DISPLAY:
+        return get_format(DISPLAY)
+    else:
+        return get_format(Surface((1, 1)))
+
+
+def get_format(surface):
+    """ Return what decides if blitting the surface needs a conversion """
+    depth = surface.get_bitsize()
+    alpha = surface.get_flags() & pygame.SRCALPHA
+    if depth == 8:
+        colors = tuple(tuple(color)[:3] for color in surface.get_palette())
+    else:
+        colors = surface.get_masks()
+
+    return (depth, alpha, colors)
+
+
+def is_display_format(surface):
+    return get_format(surface) == get_display_format()
+
+
+def normalize_surface(image, lossless=True):
+    """ Return the image in the display format
+        with "lossless", the image is kept if a color would change """
+    if isinstance(image, Surface) and is_display_format(image):
+        return image
+
+    temp = Surface(image.get_size())
+    temp.blit(image, (0, 0))
+
+    if lossless:
+        if (pygame.image.tostring(temp, "RGB")
+                != pygame.image.tostring(image, "RGB")):
+            return image
+
+    return temp
+
+
+def check_formats():
+    """ Return the live surfaces blitted with a format conversion """
+    display = get_display_format()
+    return [surface for surface in list(SURFACES)
+            if get_format(surface) != display]
+
+
+def get_scale_factor(scale):
+    return SCALES.get(scale, 1)
+
+
+def scale_surface(image, dest, scale, rect=None):
+    """ Scale an area of the image on the same area of "dest",
+        which must be as big as the scaled image
+        "scale" is one of SCALES, the whole image is scaled by default """
+    f = get_scale_factor(scale)
+    area = image.get_rect()
+    if rect is not None:
+        area = area.clip(rect)
+
+    if not area.w or not area.h:
+        return
+
+    target = dest.subsurface((area.x * f, area.y * f, area.w * f, area.h * f))
+
+    if not scale.startswith("scale"):
+        pygame.transform.scale(image.subsurface(area), target.get_size(),
+                               target)
+        return
+
+    # scale2x reads the neighbours of each pixel, so a margin is scaled
+    # around the area to get the same pixels inside the area as scaling
+    # the whole image, the pixels around it are not updated
+    passes = f / 2
+    margin = area.inflate(passes * 2, passes * 2).clip(image.get_rect())
+
+    temp = image.subsurface(margin)
+    for i in range(passes):
+        temp = pygame.transform.scale2x(temp)
+
+    temp.set_colorkey(None)
+    target.blit(temp, (0, 0), ((area.x - margin.x) * f,
+                               (area.y - margin.y) * f,
+                               area.w * f, area.h * f))
+
+
+def blit_all(surface, blits):
+    """ Blit a list of (source, dest, area) in one call if possible """
+    try:
+        surface.blits(blits, False)
+    except AttributeError:  # pygame < 1.9.4
+        for source, dest, area in blits:
+            surface.blit(source, dest, area)
+
+
 #------------------------------------------------------------------------------
 # BUILT-IN FUNCTIONS
 #------------------------------------------------------------------------------
@@ -18,7 +18,7 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
-from xml.dom.minidom import parse
+import os
 
 import fxplib as Fxp
 
@@ -64,55 +64,75 @@ class Model:
         return root
 
     def get_palette(self, filename):
-        # parse xml file
-        doc = parse(filename)
-
-        # get name and create palette
-        name = doc.childNodes[0].attributes["name"].value
-        palette = Fxp.Palette(name)
-
-        # get colorkey
-        node = doc.getElementsByTagName("colorkey")[0]
-        string = node.firstChild.nodeValue
-        colorkey = self.split_color(string)
-        palette.set_colorkey(colorkey)
-
-        # get default color
-        node = doc.getElementsByTagName("default")[0]
-        string = node.firstChild.nodeValue
-        palette.set_default(string)
-
-        # get colors
-        colors = doc.getElementsByTagName("color")
-        for node in colors:
-            # get color name
-            colorname = node.attributes["name"].value
-            color = Fxp.Color(colorname)
-
-            # get values
-            for child in node.childNodes:
-                if child.nodeType == child.ELEMENT_NODE:
-                    if child.tagName == "value":
-                        # get tone
-                        tone = child.attributes["tone"].value
-
-                        # get value
-                        string = child.firstChild.nodeValue
-                        value = self.split_color(string)
-
-                        # add value
-                        color.set_rgb(tone, value)
-
-            # add color
-            palette.append(color)
-
-        doc.unlink()  # destroy dom object
-
-        return palette
-
-    def split_color(self, string):
-        r, g, b = string.split(",", 3)
-        return (int(r), int(g), int(b))
+        # compiled packages have their palettes parsed already
+        bundle = Fxp.get_bundle(filename)
+        if bundle:
+            palette = bundle.get_palette(filename)
+            if palette:
+                return palette
+
+        # parse the file, unless a file with the same content was parsed
+        return Fxp.load_palette(filename)
+
+    def preload_palettes(self):
+        """ Load the palettes of all the packages at once,
+            ready to be used by the surfaces created until now,
+            so that switching palettes takes no time """
+        # packages are directories, archives or bundles
+        packages = set()
+        for name in os.listdir("packages"):
+            package, extension = os.path.splitext(name)
+            if(extension in (".fxpk", ".fxpb")
+            or os.path.isdir("packages/" + name)):
+                packages.add(package)
+
+        palettes = {}
+        for package in sorted(packages):
+            directory = "packages/" + package + "/palettes"
+            for name in Fxp.list_files(directory):
+                if os.path.splitext(name)[1] == ".pal":
+                    filename = directory + "/" + name
+                    palette = self.get_palette(filename)
+                    palette.get_variant(Fxp.LAYOUT or palette)
+                    palettes[filename] = palette
+
+        return palettes
+
+    def compile_package(self, package):
+        """ Compile a package in a bundle file, read instead of the package
+            files as long as they are not modified
+            the images are written in the format of the current palette """
+        directory = "packages/" + package
+
+        sources = []
+        objects = {}
+        palettes = {}
+        images = {}
+        for root, dirs, files in os.walk(directory):
+            for name in sorted(files):
+                filename = root + "/" + name
+                extension = os.path.splitext(name)[1]
+                if extension == ".fxpq":
+                    # broken files are left out, to fail when they are used
+                    try:
+                        objects[filename] = Fxp.parse_fxpq(filename)
+                    except Exception, e:
+                        print(":: FXPQ Error in file \"{}\": {}"
+                              .format(filename, e))
+                        continue
+                elif extension == ".pal":
+                    palettes[filename] = self.get_palette(filename)
+                elif extension == ".png":
+                    image = Fxp.pygame.image.load(filename)
+                    images[filename] = Fxp.normalize_surface(image,
+                                                             lossless=False)
+                else:
+                    continue
+
+                sources.append(filename)
+
+        Fxp.write_bundle(directory + ".fxpb", sources, objects, palettes,
+                         images)
 
     def read_file(self, filename, mode, sizemax):
         f = open(filename, mode)
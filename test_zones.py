@@ -0,0 +1,81 @@
+#!/usr/bin/env python2
+# -*- coding: utf8 -*-
+
+# fxp2 - Multiplayer platform RPG
+# Copyright (C) 2009 - 2013 MARTIN Jérôme <poupoule.studios@sfr.fr>
+# This file is part of the fxp2 program.
+#
+# fxp2 is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# fxp2 is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import os
+import unittest
+
+import fxplib as Fxp
+from model import Model
+
+
+class ZonesTest(unittest.TestCase):
+    """ Stream the zones of the zones test package, whose two zones
+        share the same cloud object """
+    def setUp(self):
+        # an 8 bits display like the game's, without a window
+        if not "SDL_VIDEODRIVER" in os.environ:
+            os.environ["SDL_VIDEODRIVER"] = "dummy"
+        Fxp.pygame.init()
+        self.screen = Fxp.pygame.display.set_mode((512, 384), 0, 8)
+
+        Fxp.PALETTE = Model().get_palette(
+            "packages/Manafia/palettes/rilouw.pal")
+        Fxp.set_display(self.screen)
+
+        self.builder = Fxp.Builder("packages/_Zones")
+        self.root = self.builder.root
+        self.zones = Fxp.Zones(self.root)
+
+        # build the east zone in the background
+        while self.zones.queue:
+            self.zones.run()
+
+        self.west = self.zones.zones["zon_west"]
+        self.east = self.zones.zones["zon_east"]
+
+    def get_users(self, asset):
+        return Fxp.ASSETS.entries[asset][2]
+
+    def test_shared_child(self):
+        cloud = self.east.objects["obj_cloud"]
+        self.assertIs(self.west.objects["obj_cloud"], cloud)
+        asset = cloud.asset
+        users = self.get_users(asset)
+
+        # the other zone still uses the cloud
+        self.west.unload()
+        self.assertEqual(cloud.asset, asset)
+        self.assertEqual(self.get_users(asset), users)
+        self.east.render(self.screen)
+
+        # the cloud is not built again
+        self.west.activate()
+        self.assertIs(self.west.objects["obj_cloud"], cloud)
+        self.assertEqual(self.get_users(asset), users)
+
+        # the last zone using the cloud releases it
+        self.west.unload()
+        self.east.unload()
+        self.assertIsNone(cloud.asset)
+        self.assertEqual(self.get_users(asset), users - 1)
+
+if __name__ == "__main__":
+    unittest.main()
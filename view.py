@@ -21,7 +21,6 @@
 import fxplib as Fxp
 
 import time
-import copy
 
 
 class Gauge(Fxp.Image):
@@ -48,10 +47,10 @@ class Gauge(Fxp.Image):
         self.mana = Fxp.Image("fluid_mana", "packages/gauges_fluid.png")
         self.mana.set_pos((41, 31))
         self.mana.set_size((22, 44))
-        self.mana.image.replace_color(Fxp.PALETTE.get_rgb("Red", "medium"),
-                                      Fxp.PALETTE.get_rgb("Blue", "medium"))
-        self.mana.image.replace_color(Fxp.PALETTE.get_rgb("Red", "dark"),
-                                      Fxp.PALETTE.get_rgb("Blue", "dark"))
+        self.mana.recolor(Fxp.PALETTE.get_rgb("Red", "medium"),
+                          Fxp.PALETTE.get_rgb("Blue", "medium"))
+        self.mana.recolor(Fxp.PALETTE.get_rgb("Red", "dark"),
+                          Fxp.PALETTE.get_rgb("Blue", "dark"))
 
         # set fluid animation
         fluid_frames = {}
@@ -67,11 +66,8 @@ class Gauge(Fxp.Image):
             (200, (88, 0)),
         ))
 
-        self.life.frames = fluid_frames
-        self.life.frame = "full"
-
-        self.mana.frames = copy.deepcopy(fluid_frames)
-        self.mana.frame = "full"
+        self.life.set_frames(fluid_frames, "full")
+        self.mana.set_frames(fluid_frames, "full")
 
         # load text
         self.life_text = Fxp.Label("label_life", "{}%"
@@ -120,16 +116,16 @@ class Gauge(Fxp.Image):
             amount = 0.0
             obj.y_offset = 0
             obj.set_size((lw, lh))
-            obj.frame = "empty"
+            obj.play("empty")
         elif amount <= 1:
             obj.y_offset = (lh - 7) - ((lh - 7) * amount)
             obj.set_size((lw, lh - obj.y_offset))
-            obj.frame = "full"
+            obj.play("full")
         else:
             amount = 1.0
             obj.y_offset = 0
             obj.set_size((lw, lh))
-            obj.frame = "full"
+            obj.play("full")
 
         if fluid == "life":
             self.life_amount = amount
@@ -138,14 +134,15 @@ class Gauge(Fxp.Image):
 
 
 class View:
-    def __init__(self, model, size, scale_mode=None, fullscreen=False):
+    def __init__(self, model, size, scale_mode=None, fullscreen=False,
+                 render_mode="full"):
         self.model = model
 
         # screen size and options
+        self.factor = Fxp.get_scale_factor(scale_mode)
         w, h = size
-        if scale_mode == "scale2x" or scale_mode == "simple":
-            w *= 2
-            h *= 2
+        w *= self.factor
+        h *= self.factor
 
         self.flags = 0
         if fullscreen:
@@ -159,6 +156,11 @@ class View:
         self.clock = Fxp.pygame.time.Clock()
         self.root = None
 
+        # "full" redraws everything, "dirty" only what changed on the screen
+        # and "flat" draws the images straight on the screen
+        self.render_mode = render_mode
+        self.rendered_root = None
+
         while not Fxp.pygame.display.get_active():
             time.sleep(0.1)
 
@@ -173,11 +175,52 @@ class View:
         Fxp.FONT = Fxp.Font("packages/font.png", 6)
 
         # prepare screen
+        Fxp.set_display(self.screen)
         self.screen.set_palette(Fxp.PALETTE.get_all_rgb())
         self.screen.set_colorkey(Fxp.PALETTE.colorkey)
         self.screen.fill(Fxp.PALETTE.get_rgb("Black", "dark"))
 
+        # every palette, ready to be switched to within a frame
+        self.palettes = self.model.preload_palettes()
+
+    def switch_palette(self, filename):
+        """ Load another palette and recolor the screen
+            and all the surfaces """
+        palette = self.palettes.get(filename)
+        if palette is None:
+            palette = self.model.get_palette(filename)
+
+        Fxp.use_palette(palette)
+
+        self.screen.set_palette(Fxp.PALETTE.get_variant(Fxp.LAYOUT)[0])
+        self.screen.set_colorkey(Fxp.PALETTE.colorkey)
+        self.root.set_redraw()
+
     def load_game(self):
+        for root in self.build_game():
+            pass
+
+        self.root = root
+
+    def build_game(self):
+        """ Build the game scene step by step, so that it can be built
+            between the frames of another scene.
+            None is yielded after each step, and the root object at the end
+        """
+        # decode the images of the scene at once, in the background
+        golfia = "packages/Manafia/maps/Golfia/"
+        for step in Fxp.ASSETS.preload_steps(["packages/gauges.png",
+                            "packages/gauges_fluid.png",
+                            "packages/cursor.png",
+                            "packages/Manafia/~temp/ground1.png",
+                            "packages/Manafia/common/euhmeuh.png",
+                            "packages/Manafia/common/base.png"]
+                           + [golfia + name + ".png" for name in
+                              ("mountain1", "mountain2", "cloud1", "cloud2",
+                               "cave1", "cave2", "dirt", "grass", "tree",
+                               "portal")]):
+            yield None
+
         # create the gui layer
         gui = Fxp.Image("gui")
         gui.set_size(self.get_size())
@@ -203,46 +246,55 @@ class View:
         horizon.load_from_solid_color(Fxp.PALETTE.get_rgb("Cyan", "light"),
                                       self.get_size())
 
+        yield None
+
         # create moutains background
         mountain1 = Fxp.Background("mountain1")
         mountain1.load_from_file("packages/Manafia/maps/Golfia/mountain1.png")
-        mountain1.duplicate()
+        mountain1.wrap()
         mountain1.make_movable()
+        yield None
 
         mountain2 = Fxp.Background("mountain2")
         mountain2.load_from_file("packages/Manafia/maps/Golfia/mountain2.png")
-        mountain2.duplicate()
+        mountain2.wrap()
         mountain2.make_movable()
+        yield None
 
         # create clouds
         cloud1 = Fxp.MovingObject("cloud1")
         cloud1.load_from_file("packages/Manafia/maps/Golfia/cloud1.png")
         cloud1.set_pos((16, -16))
         cloud1.make_movable()
+        yield None
 
         cloud2 = Fxp.MovingObject("cloud2")
         cloud2.load_from_file("packages/Manafia/maps/Golfia/cloud2.png")
         cloud2.set_pos((384, -32))
         cloud2.make_movable()
+        yield None
 
         # ground
         ground1 = Fxp.Background("ground1")
         ground1.load_from_file("packages/Manafia/~temp/ground1.png")
-        ground1.duplicate()
+        ground1.wrap()
         ground1.make_movable()
+        yield None
 
         # create cave background
         cave1 = Fxp.Background("cave1")
         cave1.load_from_file("packages/Manafia/maps/Golfia/cave1.png")
-        cave1.duplicate()
+        cave1.wrap()
         cave1.make_movable()
         cave1.fix_to(ground1, "bottom")
+        yield None
 
         cave2 = Fxp.Background("cave2")
         cave2.load_from_file("packages/Manafia/maps/Golfia/cave2.png")
-        cave2.duplicate()
+        cave2.wrap()
         cave2.make_movable()
         cave2.fix_to(ground1, "bottom")
+        yield None
 
         dirt = Fxp.Tileset("dirt", "packages/Manafia/maps/Golfia/dirt.png", 16)
         dirt.solid = True
@@ -261,6 +313,8 @@ class View:
         dirt.add_rule("cul", (4, 1), 0x7F)
         dirt.add_rule("cdr", (3, 2), 0xDB)
         dirt.add_rule("cdl", (4, 2), 0x7E)
+        yield None
+
         grass = Fxp.Tileset("grass",
                             "packages/Manafia/maps/Golfia/grass.png", 16)
         grass.solid = False
@@ -269,6 +323,8 @@ class View:
         grass.add_rule("right", [(2, 0), (4, 0)], 0x10, mask=0x18)
         grass.add_rule("small", [(0, 1), (1, 1), (2, 1), (3, 1), (4, 1)], 0x00,
                        mask=0x18)
+        yield None
+
         ground2 = Fxp.Map("ground2", 16,
                           "packages/Manafia/maps/Golfia/golfia.map")
         ground2.set_size((3072, 1536))
@@ -277,9 +333,11 @@ class View:
         ground2.add_tileset(grass, mixable=False)
         ground2.make_movable()
         ground2.solid = True
+        yield None
 
         # FIXME (remove me)
-        ground2.update_collisions()
+        for step in ground2.update_collisions_steps():
+            yield None
         # loop = 0
         # for hitbox in ground2.hitboxes:
         #     rx, ry, rw, rh = hitbox
@@ -289,6 +347,7 @@ class View:
         #     robj.set_pos((rx+2,ry+2))
         #     ground2.add_child(robj)
         #     loop += 1
+        yield None
 
         # I'd like to be a tree !
         tree = Fxp.MovingObject("tree")
@@ -297,6 +356,7 @@ class View:
         tree.make_movable()
         tree.solid = True
         tree.hitboxes.append((18, 6, 40, 1))
+        yield None
 
         # portals, now we're getting serious...
         portal = Fxp.MovingObject("portal")
@@ -317,8 +377,8 @@ class View:
             (100, (160 * 7, 0))
         ))
 
-        portal.frames = portal_frames
-        portal.frame = "idle"
+        portal.set_frames(portal_frames, "idle")
+        yield None
 
         # character
         character = Fxp.MovingObject("character")
@@ -352,8 +412,8 @@ class View:
             (150, (42 * 7, 46))
         ))
 
-        character.frames = char_frames
-        character.frame = "idle"
+        character.set_frames(char_frames, "idle")
+        yield None
 
         # ennemy !
         ennemy = Fxp.MovingObject("ennemy")
@@ -365,8 +425,8 @@ class View:
         ennemy.solid = True
         ennemy.hitboxes.append((13, 16, 25, 30))
 
-        ennemy.frames = copy.deepcopy(char_frames)
-        ennemy.frame = "idle"
+        ennemy.set_frames(char_frames, "idle")
+        yield None
 
         # create buttons
         text_option = "Options".center(22)
@@ -466,18 +526,18 @@ class View:
         cursor.z = 10.0
 
         # define camera target
-        camera.target = character
+        camera.set_target(character)
         camera.z_dist = 30
         #camera.zone = (128,128,256,128)
 
         # pack objects
-        camera.add_child(mountain1)
-        camera.add_child(mountain2)
-        camera.add_child(cave1)
-        camera.add_child(cave2)
+        camera.add_background(mountain1)
+        camera.add_background(mountain2)
+        camera.add_background(cave1)
+        camera.add_background(cave2)
+        camera.add_background(ground1)
         camera.add_child(cloud1)
         camera.add_child(cloud2)
-        camera.add_child(ground1)
         camera.add_child(ground2)
         camera.add_child(tree)
         camera.add_child(portal)
@@ -501,31 +561,19 @@ class View:
         root.add_child(inputdev)
 
         # give the controller access to the root object
-        self.root = root
+        yield root
 
     def get_width(self):
-        if self.is_scale():
-            return self.width / 2
-        else:
-            return self.width
+        return self.width / self.factor
 
     def get_height(self):
-        if self.is_scale():
-            return self.height / 2
-        else:
-            return self.height
+        return self.height / self.factor
 
     def get_size(self):
-        if self.is_scale():
-            return (self.width / 2, self.height / 2)
-        else:
-            return (self.width, self.height)
+        return (self.get_width(), self.get_height())
 
     def is_scale(self):
-        if (self.scale == "scale2x" or self.scale == "simple"):
-            return True
-        else:
-            return False
+        return self.factor > 1
 
     def refresh(self):
         self.clock.tick(self.framerate)
@@ -535,14 +583,38 @@ class View:
         if fps:
             fps.set_text(str(self.clock.get_fps()))
 
-        # tick objects
-        self.root.tick(Fxp.pygame.time.get_ticks())
+        # show the animation frames that are due
+        Fxp.SCHEDULER.run(Fxp.pygame.time.get_ticks())
+
+        # check objects refresh
+        self.root.check_force()
 
         # render all objects
-        self.render_all()
+        rects = self.render_all()
 
         # flip screen
-        Fxp.pygame.display.flip()
+        if rects is None:
+            Fxp.pygame.display.flip()
+        else:
+            Fxp.pygame.display.update(rects)
 
     def render_all(self):
-        self.root.render(self.screen)
+        if self.render_mode == "flat":
+            self.root.render_flat(self.screen)
+            return None
+
+        # redraw everything the first time a scene is rendered
+        if(self.render_mode != "dirty"
+        or self.root is not self.rendered_root):
+            self.rendered_root = self.root
+            self.root.render(self.screen)
+            return None
+
+        rects = self.root.render_dirty(self.screen)
+
+        # the whole screen changed, e.g. the camera scrolled far
+        w, h = self.size
+        if sum([r.w * r.h for r in rects]) > w * h * self.root.dirty_ratio:
+            return None
+
+        return rects